@@ -30,7 +30,13 @@
 
 import os
 import json
+import time
+import queue
+import atexit
+import random
+import asyncio
 import logging
+import logging.handlers
 
 __version__ = '1.2.1'
 
@@ -38,13 +44,72 @@ CONFIG = {
     'logpath': './',
     'logformat': '[%(asctime)s] %(name)s - %(message)s',
     'loglevel': 'WARNING',
+    # Size in bytes the log file is rotated at and rotated files kept
+    'logmaxbytes': 10485760,
+    'logbackups': 5,
+    # Fraction of the access log lines and debug messages written, at most
+    # log_rate_limit per second, 0 for no limit
+    'log_sample_rate': 1,
+    'log_rate_limit': 0,
     'verbose': False,
+    'loop': {
+        # asyncio or uvloop, falling back to asyncio if it's not installed
+        'policy': 'asyncio',
+        'debug': False,
+        'slow_callback_duration': 0.1,
+        # SO_RCVBUF/SO_SNDBUF of the tunneled TCP connections, None to keep
+        # the system defaults
+        'rcvbuf': None,
+        'sndbuf': None
+    },
+    'tls': {
+        # Oldest protocol version accepted, TLSv1.2 or TLSv1.3, and OpenSSL
+        # cipher list of TLSv1.2, favoring AEAD suites with forward secrecy
+        'min_version': 'TLSv1.2',
+        'ciphers': 'ECDHE+AESGCM:ECDHE+CHACHA20',
+        # Issue session tickets (server) and resume the last session of each
+        # server on new connections (client)
+        'session_resumption': True
+    },
+    'tracing': {
+        # Fraction of the chunks timed at each hop of the tunnel, 0 to disable
+        # tracing, and JSON lines file the traces are appended to
+        'sample_rate': 0,
+        'trace_file': None,
+        # Directory of the profiles taken between two profile_signal, None to
+        # not install the handler
+        'profile_dir': None,
+        'profile_signal': 'SIGUSR1'
+    },
     'server': {
         'host': '127.0.0.1',
         'port': 8080,
         'certfile': None,
         'keyfile': None,
-        'reverse': False
+        'reverse': False,
+        'poll_timeout': 30,
+        'max_poll_size': 1048576,
+        'high_watermark': 262144,
+        'low_watermark': 65536,
+        'metrics': False,
+        'workers': 1,
+        # Seconds after which tunnels with no client activity, or opened for
+        # too long, are closed, 0 to never expire them
+        'idle_timeout': 300,
+        'max_lifetime': 0,
+        # Bytes per second shared by all the tunnels in each direction, handed
+        # out in quantum bytes turns, and rate limits of every tunnel and
+        # client address, 0 for no limit
+        'bandwidth': 0,
+        'quantum': 16384,
+        'tunnel_rate': 0,
+        'tunnel_burst': 262144,
+        'client_rate': 0,
+        'client_burst': 1048576,
+        # Accept compression when requested by the client
+        'compression': True,
+        'compression_level': 6,
+        'compression_threshold': 1024
     },
     'client': {
         'host': '127.0.0.1',
@@ -52,20 +117,60 @@ CONFIG = {
         'target_host': None,
         'target_port': None,
         'server_host': '127.0.0.1',
-        'server_port': 8080
+        'server_port': 8080,
+        # Several tunneld as host:port, new tunnels are placed on the one with
+        # the lowest latency or the fewest tunnels according to balancing,
+        # servers failing failure_threshold times in a row are left out until
+        # a health check succeeds reset_timeout seconds later, new tunnels
+        # moving on to the next server after connect_timeout seconds
+        'servers': [],
+        'balancing': 'latency',
+        'health_check_interval': 5,
+        'failure_threshold': 3,
+        'reset_timeout': 10,
+        'connect_timeout': 5,
+        'transport': 'rest',
+        # Additional endpoints served by the same process, each a dict with
+        # target_host, target_port, port, optionally host and reverse, e.g.
+        # {"port": 2222, "target_host": "10.0.0.5", "target_port": 22}
+        'forwardings': [],
+        # Request zlib compression of the rest and ws transports
+        'compression': False,
+        'compression_level': 6,
+        'compression_threshold': 1024,
+        # Tunnels opened in advance and their max age in seconds, 0 to open
+        # them on demand
+        'tunnel_pool_size': 0,
+        'tunnel_pool_ttl': 30,
+        'max_batch_size': 65536,
+        'flush_delay': 0,
+        # Concurrent PUTs of the rest transport
+        'write_window': 4,
+        # Seconds a rest connection keeps retrying to reach the server before
+        # being closed, resuming where it left off if it succeeds
+        'resume_timeout': 60,
+        'high_watermark': 262144,
+        'low_watermark': 65536,
+        'metrics_host': '127.0.0.1',
+        'metrics_port': None,
+        'pool_limit': 0,
+        'pool_limit_per_host': 0,
+        'keepalive_timeout': 30,
+        'dns_cache_ttl': 10
     }
 }
 
 
 def read_configuration(filepath):
-    global CONFIG
-    CONFIG = json.load(filepath)
+    # Update in place, modules holding a reference to CONFIG must see the
+    # values read from file
+    for key, value in json.load(filepath).items():
+        set_config_key(key, value)
 
 
 def set_config_key(key, value):
-    global CONFIG
     if isinstance(value, dict):
-        CONFIG[key].update(value)
+        CONFIG.setdefault(key, {}).update(value)
     else:
         CONFIG[key] = value
 
@@ -78,6 +183,62 @@ LOGLEVEL_MAP = {
 }
 
 
+# Logger of the lines written by aiohttp for every request served, one per
+# tunneled chunk with the rest transport
+ACCESS_LOGGER = 'aiotunnel.tunneld.access'
+
+
+class SamplingFilter(logging.Filter):
+
+    """Keep a sample_rate fraction of the records produced on the hot paths, access log lines
+    and debug messages, at most limit per second, letting everything else through"""
+
+    def __init__(self, sample_rate=1, limit=0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.limit = limit
+        self.allowance = limit
+        self.last = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG and record.name != ACCESS_LOGGER:
+            return True
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        if self.limit:
+            now = time.monotonic()
+            self.allowance = min(self.limit, self.allowance + (now - self.last) * self.limit)
+            self.last = now
+            if self.allowance < 1:
+                return False
+            self.allowance -= 1
+        return True
+
+
+class LogListener(logging.handlers.QueueListener):
+
+    """Write the records queued by the event loop from a thread, started again in the forked
+    workers as threads don't survive a fork"""
+
+    def __init__(self, queue_handler, *handlers):
+        self.queue_handler = queue_handler
+        super().__init__(queue_handler.queue, *handlers, respect_handler_level=True)
+
+    def after_fork(self):
+        # The parent thread is gone along with the records it didn't write
+        self.queue = self.queue_handler.queue = queue.SimpleQueue()
+        self._thread = None
+        self.start()
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+# Started by setup_logging
+log_listener = None
+
+
 def setup_logging():
     DEFAULT_LOGPATH = os.getenv('LOGPATH', CONFIG['logpath'])
     DEFAULT_FORMAT = os.getenv('LOG_FORMAT', CONFIG['logformat'])
@@ -86,8 +247,10 @@ def setup_logging():
     logger = logging.getLogger('aiotunnel')
     logger.setLevel(LOGLEVEL_MAP[LOGLEVEL])
 
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler(os.path.join(DEFAULT_LOGPATH, 'aiotunnel.log'))
+    # create file handler which logs even debug messages, rotated once too big
+    fh = logging.handlers.RotatingFileHandler(os.path.join(DEFAULT_LOGPATH, 'aiotunnel.log'),
+                                              maxBytes=CONFIG['logmaxbytes'],
+                                              backupCount=CONFIG['logbackups'])
     fh.setLevel(logging.DEBUG)
 
     # create console handler with a higher log level
@@ -100,6 +263,40 @@ def setup_logging():
     ch.setFormatter(ch_formatter)
     fh.setFormatter(formatter)
 
-    # Add stream handler to the logger
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+    # The event loop only queues the records, the disk and console writes
+    # happen in the listener thread
+    qh = logging.handlers.QueueHandler(queue.SimpleQueue())
+    qh.addFilter(SamplingFilter(CONFIG['log_sample_rate'], CONFIG['log_rate_limit']))
+    logger.addHandler(qh)
+    global log_listener
+    log_listener = LogListener(qh, ch, fh)
+    log_listener.start()
+    os.register_at_fork(after_in_child=log_listener.after_fork)
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write the records still queued and stop the listener, forked workers must call it as
+    they exit without running the atexit handlers"""
+    if log_listener:
+        log_listener.stop()
+
+
+def setup_event_loop():
+    """Install the event loop policy set in the configuration, must be called before any loop
+    gets created"""
+    if CONFIG['loop']['policy'] != 'uvloop':
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logging.getLogger('aiotunnel').warning('uvloop not installed, using asyncio loop')
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def tune_event_loop(loop):
+    conf = CONFIG['loop']
+    if conf['debug']:
+        loop.set_debug(True)
+        loop.slow_callback_duration = conf['slow_callback_duration']
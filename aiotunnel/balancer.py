@@ -0,0 +1,178 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+import aiohttp
+
+from . import metrics
+
+SERVERS_UP = metrics.Gauge('aiotunnel_servers_up', 'Servers available for new tunnels')
+EJECTIONS = metrics.Counter('aiotunnel_server_ejections_total',
+                            'Servers ejected by their circuit breaker')
+
+# Weight of the last sample in the latency moving average
+LATENCY_WEIGHT = 0.3
+
+
+class Server:
+
+    """A tunneld endpoint as seen by the client: latency moving average of health checks and
+    tunnel openings, tunnels open on it and a circuit breaker. After failure_threshold
+    consecutive failures the server is ejected, no new tunnels being placed on it, until a
+    health check succeeds at least reset_timeout seconds later"""
+
+    def __init__(self, url, failure_threshold=3, reset_timeout=10):
+        self.url = url
+        self.latency = None
+        # Reported by the last health check plus those placed since
+        self.tunnels = 0
+        self.failures = 0
+        self.ejected_at = None
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @property
+    def available(self):
+        return self.ejected_at is None
+
+    def succeeded(self, now, latency=None):
+        """Record a successful request, return True if it brought the server back"""
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += (latency - self.latency) * LATENCY_WEIGHT
+        self.failures = 0
+        if self.ejected_at is not None and now - self.ejected_at >= self.reset_timeout:
+            self.ejected_at = None
+            return True
+        return False
+
+    def failed(self, now):
+        """Record a failed request, return True if it tripped the circuit breaker"""
+        self.failures += 1
+        if self.failures < self.failure_threshold:
+            return False
+        tripped = self.ejected_at is None
+        # A failing trial keeps the server out for another reset_timeout
+        self.ejected_at = now
+        return tripped
+
+
+class Balancer:
+
+    """Place new tunnels across several tunneld servers, on the available one with the lowest
+    latency or the fewest tunnels according to policy, those never measured coming last. Every
+    server gets a health check each interval seconds; cids stay pinned to the server that
+    issued them, callers report back the outcome of their requests by url and place tunnels
+    with timeout, giving up connecting to a server after connect_timeout seconds"""
+
+    def __init__(self, urls, session, policy='latency', interval=5, failure_threshold=3,
+                 reset_timeout=10, connect_timeout=5):
+        self.servers = OrderedDict(
+            (url, Server(url, failure_threshold, reset_timeout)) for url in urls
+        )
+        self.session = session
+        self.policy = policy
+        self.interval = interval
+        self.timeout = aiohttp.ClientTimeout(total=session.timeout.total,
+                                             sock_connect=connect_timeout)
+        self.recovered = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.logger = logging.getLogger('aiotunnel.balancer.Balancer')
+        SERVERS_UP.set_function(
+            lambda: sum(server.available for server in self.servers.values())
+        )
+
+    def candidates(self):
+        """Available servers, best first"""
+        servers = [server for server in self.servers.values() if server.available]
+        # A server that never answered isn't known to be fast
+        def latency(server):
+            return server.latency if server.latency is not None else float('inf')
+
+        if self.policy == 'tunnels':
+            return sorted(servers, key=lambda s: (s.tunnels, latency(s)))
+        return sorted(servers, key=lambda s: (latency(s), s.tunnels))
+
+    async def place(self):
+        """Return the candidates to try in order, waiting for a server to come back if they
+        have all been ejected"""
+        while True:
+            servers = self.candidates()
+            if servers:
+                return servers
+            self.recovered.clear()
+            await self.recovered.wait()
+
+    def placed(self, url, latency, count=1):
+        server = self.servers[url]
+        server.tunnels += count
+        self.succeeded(url, latency)
+
+    def succeeded(self, url, latency=None):
+        server = self.servers.get(url)
+        if server and server.succeeded(self.loop.time(), latency):
+            self.logger.info("Server %s is back", url)
+            self.recovered.set()
+
+    def failed(self, url):
+        server = self.servers.get(url)
+        if server and server.failed(self.loop.time()):
+            self.logger.warning("Server %s ejected after %s failures", url, server.failures)
+            EJECTIONS.inc()
+
+    def available(self, url):
+        server = self.servers.get(url)
+        return server is not None and server.available
+
+    async def check(self, server):
+        start = self.loop.time()
+        timeout = aiohttp.ClientTimeout(total=self.interval)
+        try:
+            async with self.session.get(f'{server.url}/health', timeout=timeout) as resp:
+                if resp.status >= 500:
+                    raise aiohttp.ClientError(f'{resp.status} {resp.reason}')
+                # Older servers without health checks answer 404, still alive
+                if resp.status == 200:
+                    server.tunnels = int(await resp.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            metrics.HTTP_ERRORS.inc()
+            self.failed(server.url)
+            return
+        self.succeeded(server.url, self.loop.time() - start)
+
+    async def run(self):
+        while True:
+            await asyncio.gather(*(self.check(server) for server in self.servers.values()))
+            await asyncio.sleep(self.interval)
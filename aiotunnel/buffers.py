@@ -0,0 +1,174 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Recycled read buffers of the tunneled connections.
+
+Protocols read straight into the free space of a pooled Buffer and hand the chunks read, as
+memoryview slices of it, down to their consumer with no copy, only the small reads of mostly
+idle connections being copied out. Consecutive reads fill the same
+buffer while its chunks are still queued, a buffer goes back to the pool as soon as every chunk
+sliced from it has been released and no read is in progress, its reader then lets go of it so an
+idle connection holds no buffer. Releasing is only an optimization: a chunk never released just
+leaves its buffer to the garbage collector.
+"""
+
+from itertools import count
+
+from . import metrics
+
+# Size classes of the pooled buffers, reads use the smallest one fitting the
+# size hint of the transport or, when there's none, start from the smallest
+# and move up a class every time a read fills all the room it was given
+SIZE_CLASSES = (16384, 65536, 262144)
+
+# A new buffer is taken when less than this fraction of the current one is left
+MIN_READ_FRACTION = 4
+
+# Reads smaller than this landing in a buffer no other chunk uses are copied
+# out and the buffer recycled right away, a few bytes waiting to be consumed
+# must not hold a whole buffer
+COPY_SIZE = 2048
+
+# Free buffers kept per size class
+MAX_FREE_BUFFERS = 64
+
+BUFFERS_TAKEN = metrics.Counter('aiotunnel_read_buffers_total',
+                                'Read buffers taken from the pool, by origin', ('origin',))
+BUFFERS_ALLOCATED = BUFFERS_TAKEN.labels('allocated')
+BUFFERS_REUSED = BUFFERS_TAKEN.labels('reused')
+
+
+class Buffer(bytearray):
+
+    """A pooled bytearray, refs counts the chunks sliced from it not released yet, lease tells
+    apart the successive readers, active is set while a read is in progress and reader is the
+    BufferReader filling it"""
+
+    __slots__ = ('refs', 'lease', 'active', 'reader')
+
+
+class BufferPool:
+
+    def __init__(self, size_classes=SIZE_CLASSES, max_free=MAX_FREE_BUFFERS):
+        self.size_classes = size_classes
+        self.max_free = max_free
+        self.free = {size: [] for size in size_classes}
+        self.leases = count(1)
+
+    def acquire(self, size):
+        size = next((s for s in self.size_classes if s >= size), self.size_classes[-1])
+        free = self.free[size]
+        if free:
+            buf = free.pop()
+            BUFFERS_REUSED.inc()
+        else:
+            buf = Buffer(size)
+            BUFFERS_ALLOCATED.inc()
+        buf.refs = 0
+        buf.lease = next(self.leases)
+        buf.active = True
+        buf.reader = None
+        return buf
+
+    def release(self, chunk):
+        """Release a chunk once its content has been copied or written out, it must not be
+        used anymore"""
+        if not isinstance(chunk, memoryview):
+            return
+        try:
+            buf = chunk.obj
+            chunk.release()
+        except (ValueError, BufferError):
+            # Already released or still exported, leave it to the GC
+            return
+        if not isinstance(buf, Buffer):
+            return
+        buf.refs -= 1
+        if not buf.refs and not buf.active:
+            self.recycle(buf)
+
+    def recycle(self, buf):
+        # The reader takes a new buffer on its next read anyway, don't let an
+        # idle connection keep this one alive
+        reader, buf.reader = buf.reader, None
+        if reader is not None and reader.buffer is buf:
+            reader.buffer = None
+        free = self.free[len(buf)]
+        if len(free) < self.max_free:
+            free.append(buf)
+
+
+class BufferReader:
+
+    """Read side of a protocol, implementing get_buffer and buffer_updated of an
+    asyncio.BufferedProtocol over the pool"""
+
+    __slots__ = ('pool', 'buffer', 'lease', 'offset', 'size')
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = None
+        self.lease = 0
+        self.offset = 0
+        self.size = pool.size_classes[0]
+
+    def get_buffer(self, sizehint):
+        buf = self.buffer
+        # Keep filling the current buffer as long as it hasn't been recycled,
+        # that is while some of its chunks are queued, and there's room left
+        if (buf is None or buf.lease != self.lease or not (buf.refs or buf.active)
+                or len(buf) - self.offset < len(buf) // MIN_READ_FRACTION):
+            buf = self.buffer = self.pool.acquire(sizehint if sizehint > 0 else self.size)
+            buf.reader = self
+            self.lease = buf.lease
+            self.offset = 0
+        buf.active = True
+        return memoryview(buf)[self.offset:]
+
+    def buffer_updated(self, nbytes):
+        """Return the chunk just read"""
+        buf = self.buffer
+        if nbytes < COPY_SIZE and not buf.refs:
+            chunk = bytes(memoryview(buf)[self.offset:self.offset + nbytes])
+            buf.active = False
+            self.pool.recycle(buf)
+            return chunk
+        chunk = memoryview(buf)[self.offset:self.offset + nbytes]
+        self.offset += nbytes
+        buf.refs += 1
+        buf.active = False
+        # The read filled the buffer, the connection is busy enough for the
+        # next size class
+        if self.offset == len(buf) and len(buf) >= self.size:
+            self.size = next((s for s in self.pool.size_classes if s > self.size), self.size)
+        return chunk
+
+
+BUFFERS = BufferPool()
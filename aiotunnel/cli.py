@@ -31,9 +31,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import argparse
-from .tunnel import start_tunnel
+from .tunnel import start_tunnels, parse_forwardings
 from .tunneld import start_tunneld
-from . import CONFIG, read_configuration, set_config_key, setup_logging
+from . import CONFIG, read_configuration, set_config_key, setup_logging, setup_event_loop
 
 
 def get_parser():
@@ -43,6 +43,8 @@ def get_parser():
                         type=argparse.FileType('r'), help='Configuration file')
     parser.add_argument('--verbose', '-v', action='store_true',
                         default=False, help='Run with more logs')
+    parser.add_argument('--log-sample-rate', action='store', type=float,
+                        help='Fraction of the access log lines and debug messages written')
     parser.add_argument('--reverse', '-r', action='store_true',
                         help='Run in reverse mode e.g. client connect to the '
                         'service to expose and ask the server to open a port')
@@ -53,6 +55,33 @@ def get_parser():
     parser.add_argument('--target-port', '-P', action='store', help='Set the port for target-addr')
     parser.add_argument('--server-addr', '-sa', action='store', help='Set the target address')
     parser.add_argument('--server-port', '-sp', action='store', help='Set the target port')
+    parser.add_argument('--servers', nargs='+', metavar='HOST:PORT',
+                        help='Balance the tunnels across several servers (client)')
+    parser.add_argument('--balancing', action='store', choices=('latency', 'tunnels'),
+                        help='Place new tunnels on the server with the lowest latency or the '
+                        'fewest tunnels (client)')
+    parser.add_argument('--transport', '-t', action='store', choices=('rest', 'ws', 'stream', 'mux'),
+                        help='Set the client transport, REST calls, a WebSocket, '
+                        'streaming HTTP requests or a WebSocket shared by all connections')
+    parser.add_argument('--compress', '-z', action='store_true',
+                        help='Compress the data sent over the rest and ws transports (client)')
+    parser.add_argument('--tunnel-pool', action='store', type=int,
+                        help='Number of tunnels to keep open in advance (client)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Export metrics at /aiotunnel/metrics (server)')
+    parser.add_argument('--metrics-port', action='store', type=int,
+                        help='Export metrics on a local port at /metrics (client)')
+    parser.add_argument('--trace-rate', action='store', type=float,
+                        help='Fraction of the chunks timed at each hop of the tunnel')
+    parser.add_argument('--trace-file', action='store',
+                        help='Append the chunk traces to a JSON lines file')
+    parser.add_argument('--profile-dir', action='store',
+                        help='Profile the process between two SIGUSR1, writing the '
+                        'stats in this directory')
+    parser.add_argument('--workers', '-w', action='store', type=int,
+                        help='Number of worker processes sharing the port (server)')
+    parser.add_argument('--loop', action='store', choices=('asyncio', 'uvloop'),
+                        help='Set the event loop implementation')
     parser.add_argument('--ca', action='store', help='Set the cert. authority file')
     parser.add_argument('--cert', action='store', help='Set the crt file for SSL/TLS encryption')
     parser.add_argument('--key', action='store', help='Set the key file for SSL/TLS encryption')
@@ -71,8 +100,23 @@ def main():
         set_config_key('verbose', args.verbose)
         set_config_key('loglevel', 'DEBUG')
 
+    if args.log_sample_rate is not None:
+        set_config_key('log_sample_rate', args.log_sample_rate)
+
     setup_logging()
 
+    if args.loop:
+        set_config_key('loop', {'policy': args.loop})
+
+    setup_event_loop()
+
+    if args.trace_rate is not None:
+        set_config_key('tracing', {'sample_rate': args.trace_rate})
+    if args.trace_file:
+        set_config_key('tracing', {'trace_file': args.trace_file})
+    if args.profile_dir:
+        set_config_key('tracing', {'profile_dir': args.profile_dir})
+
     # SSL/TLS certificates
     cafile = args.ca
     certfile = args.cert
@@ -88,6 +132,8 @@ def main():
     reverse = args.reverse or CONFIG.get('reverse', False)
 
     if args.subcommand == 'client':
+        target_addr = CONFIG['client']['target_host']
+        target_port = CONFIG['client']['target_port']
         if args.target_port:
             target_port = int(args.target_port)
             set_config_key('client', {'target_port': target_port})
@@ -106,10 +152,31 @@ def main():
         if args.server_port:
             server_port = args.server_port
             set_config_key('server', {'port': server_port})
+        if args.transport:
+            set_config_key('client', {'transport': args.transport})
+        if args.metrics_port:
+            set_config_key('client', {'metrics_port': args.metrics_port})
+        if args.compress:
+            set_config_key('client', {'compression': True})
+        if args.tunnel_pool:
+            set_config_key('client', {'tunnel_pool_size': args.tunnel_pool})
+        if args.servers:
+            set_config_key('client', {'servers': args.servers})
+        if args.balancing:
+            set_config_key('client', {'balancing': args.balancing})
         scheme = 'https' if cafile else 'http'
-        url = f'{scheme}://{server_host}:{server_port}/aiotunnel'
-        start_tunnel(url, (client_host, client_port), (target_addr, target_port),
-                     reverse, cafile=cafile, certfile=certfile, keyfile=keyfile)
+        servers = CONFIG['client']['servers'] or [f'{server_host}:{server_port}']
+        urls = [f'{scheme}://{server}/aiotunnel' for server in servers]
+        try:
+            forwardings = parse_forwardings(CONFIG['client']['forwardings'], reverse)
+        except ValueError as e:
+            parser.error(str(e))
+        if target_addr and target_port:
+            forwardings.insert(0, ((client_host, int(client_port)),
+                                   (target_addr, int(target_port)), reverse))
+        if not forwardings:
+            parser.error('a target address and port or a list of forwardings is required')
+        start_tunnels(urls, forwardings, cafile=cafile, certfile=certfile, keyfile=keyfile)
     else:
         if args.addr:
             server_host = args.addr
@@ -117,5 +184,10 @@ def main():
         if args.port:
             server_port = args.port
             set_config_key('server', {'port': server_port})
+        if args.metrics:
+            set_config_key('server', {'metrics': True})
+        if args.workers:
+            set_config_key('server', {'workers': args.workers})
         start_tunneld(server_host, server_port, reverse,
-                      cafile=cafile, certfile=certfile, keyfile=keyfile)
+                      cafile=cafile, certfile=certfile, keyfile=keyfile,
+                      workers=CONFIG['server']['workers'])
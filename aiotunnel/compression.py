@@ -0,0 +1,109 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import zlib
+from collections import deque
+
+from . import metrics
+
+# Request header advertising the compression supported by the client, echoed
+# back by the server when it accepts it
+HEADER = 'X-Aiotunnel-Compression'
+CODEC = 'zlib'
+
+# Transports sending every chunk as a message of its own, the only ones able
+# to carry compressed chunks
+TRANSPORTS = ('rest', 'ws')
+
+# Flag byte prefixed to every payload of a compressed tunnel
+RAW = b'\x00'
+ZLIB = b'\x01'
+
+COMPRESSION_SAVED = metrics.Counter('aiotunnel_compression_saved_bytes_total',
+                                    'Bytes saved by compressing the tunneled chunks')
+COMPRESSION_SKIPPED = metrics.Counter('aiotunnel_compression_skipped_total',
+                                      'Chunks sent uncompressed, by reason', ('reason',))
+SKIPPED_SMALL = COMPRESSION_SKIPPED.labels('small')
+SKIPPED_RATIO = COMPRESSION_SKIPPED.labels('ratio')
+SKIPPED_BACKOFF = COMPRESSION_SKIPPED.labels('backoff')
+
+
+class Compressor:
+
+    """Compress every chunk independently, chunks smaller than threshold or not shrinking
+    below min_ratio of their size are sent as they are. Once the average ratio of the last
+    window chunks stays above min_ratio the stream is considered incompressible (already
+    compressed or encrypted) and compression is skipped for the next backoff chunks"""
+
+    def __init__(self, level=6, threshold=1024, window=8, min_ratio=0.9, backoff=64):
+        self.level = level
+        self.threshold = threshold
+        self.min_ratio = min_ratio
+        self.backoff = backoff
+        self.ratios = deque(maxlen=window)
+        self.skip = 0
+
+    def compress(self, data):
+        if len(data) < self.threshold:
+            SKIPPED_SMALL.inc()
+            return RAW + data
+        if self.skip:
+            self.skip -= 1
+            SKIPPED_BACKOFF.inc()
+            return RAW + data
+        compressed = zlib.compress(data, self.level)
+        ratio = len(compressed) / len(data)
+        self.ratios.append(ratio)
+        if (len(self.ratios) == self.ratios.maxlen
+                and sum(self.ratios) / len(self.ratios) >= self.min_ratio):
+            self.skip = self.backoff
+            self.ratios.clear()
+        if ratio >= self.min_ratio:
+            SKIPPED_RATIO.inc()
+            return RAW + data
+        COMPRESSION_SAVED.inc(len(data) - len(compressed))
+        return ZLIB + compressed
+
+
+def decompress(data, max_size=None):
+    """Decompress a chunk, raising ValueError if it's corrupted or, with max_size set, if it
+    expands beyond max_size bytes"""
+    if data[:1] != ZLIB:
+        return data[1:]
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(memoryview(data)[1:], max_size or 0)
+    except zlib.error as e:
+        raise ValueError(f'Corrupted chunk: {e}')
+    if decompressor.unconsumed_tail:
+        raise ValueError(f'Chunk expanding beyond {max_size} bytes')
+    if not decompressor.eof:
+        raise ValueError('Truncated chunk')
+    return result
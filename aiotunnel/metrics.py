@@ -0,0 +1,262 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Lightweight metrics, exported in the Prometheus text format.
+
+Every metric is a plain integer (or float) updated in place, histograms are pre-bucketed so an
+observation is just a bisect and an increment, cheap enough to stay always on. Labeled metrics
+are meant to be resolved once with `labels` and the returned child reused in hot paths.
+"""
+
+from time import monotonic
+from bisect import bisect_left
+
+from aiohttp import web, TraceConfig
+
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    pairs.extend(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children = {}
+        if not labelnames:
+            self.children[()] = self.new_child()
+        registry.register(self)
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def render(self):
+        return [f'{self.name}{format_labels(self.labelnames, values)} {child.get()}'
+                for values, child in self.children.items()]
+
+
+class Value:
+
+    __slots__ = ('value', 'func')
+
+    def __init__(self):
+        self.value = 0
+        self.func = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, func):
+        """Compute the value calling func at every scrape"""
+        self.func = func
+
+    def get(self):
+        return self.func() if self.func else self.value
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def new_child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self.children[()].value += amount
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.children[()].value -= amount
+
+    def set(self, value):
+        self.children[()].value = value
+
+    def set_function(self, func):
+        self.children[()].func = func
+
+
+class HistogramValue:
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def render(self):
+        lines = []
+        for values, child in self.children.items():
+            cumulative = 0
+            bounds = [str(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, child.counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, values, (f'le="{bound}"',))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {child.sum}')
+            lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+# Metrics shared by the client and the server side, directions are relative
+# to the HTTP leg of the tunnel: in is received from it, out is sent over it
+TUNNELS_ACTIVE = Gauge('aiotunnel_tunnels_active', 'Open tunneled connections')
+BYTES = Counter('aiotunnel_bytes_total', 'Tunneled bytes', ('direction',))
+CHUNKS = Counter('aiotunnel_chunks_total', 'Tunneled chunks of data', ('direction',))
+QUEUE_DEPTH = Gauge('aiotunnel_queue_depth', 'Chunks waiting in the tunnel queues', ('queue',))
+HTTP_LATENCY = Histogram('aiotunnel_http_request_duration_seconds',
+                         'Duration of the HTTP requests between client and server', ('method',))
+CONNECT_LATENCY = Histogram('aiotunnel_target_connect_duration_seconds',
+                            'Time to open a connection to the target')
+ERRORS = Counter('aiotunnel_errors_total', 'Errors by kind', ('kind',))
+RETRIES = Counter('aiotunnel_retries_total', 'Operations retried after an error')
+WRITE_BATCH_SIZE = Histogram('aiotunnel_write_batch_bytes',
+                             'Size of the coalesced write batches', buckets=SIZE_BUCKETS)
+WRITE_FLUSHES = Counter('aiotunnel_write_flushes_total',
+                        'Write batches flushed, by reason', ('reason',))
+TUNNELS_REAPED = Counter('aiotunnel_tunnels_reaped_total',
+                         'Tunnels closed by the server once expired, by reason', ('reason',))
+
+BYTES_IN, BYTES_OUT = BYTES.labels('in'), BYTES.labels('out')
+CHUNKS_IN, CHUNKS_OUT = CHUNKS.labels('in'), CHUNKS.labels('out')
+HTTP_ERRORS = ERRORS.labels('http')
+CONNECT_ERRORS = ERRORS.labels('connect')
+CONNECTION_LOST_ERRORS = ERRORS.labels('connection_lost')
+
+
+def client_trace_config():
+    """Return an aiohttp TraceConfig observing the duration of every request of a
+    ClientSession"""
+
+    async def on_request_start(session, ctx, params):
+        ctx.start = monotonic()
+
+    async def on_request_end(session, ctx, params):
+        HTTP_LATENCY.labels(params.method).observe(monotonic() - ctx.start)
+
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+@web.middleware
+async def server_middleware(request, handler):
+    start = monotonic()
+    try:
+        return await handler(request)
+    finally:
+        HTTP_LATENCY.labels(request.method).observe(monotonic() - start)
+
+
+async def metrics_handler(request):
+    return web.Response(text=REGISTRY.render(), content_type='text/plain')
+
+
+async def start_metrics_server(host, port):
+    """Serve the metrics on http://host:port/metrics, return the runner to clean up on
+    shutdown"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
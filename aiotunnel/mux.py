@@ -0,0 +1,202 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Multiplexing of many TCP connections over a single WebSocket.
+
+Every connection is a stream identified by an integer id, its lifecycle and data travel as
+frames made of a fixed header (stream id, flags, payload length) followed by the payload. A
+single WebSocket message can carry many frames, the sending side coalesces everything queued
+into one message.
+
+Each stream has its own flow control in both directions: a side sends at most WINDOW_SIZE
+bytes of DATA ahead of the WINDOW frames of its peer, granting credit for the bytes consumed,
+so a slow stream never holds back the others sharing the WebSocket.
+"""
+
+import struct
+import asyncio
+import logging
+
+import aiohttp
+
+from . import metrics
+from .protocol import FlowControl, HIGH_WATERMARK, LOW_WATERMARK
+
+
+# stream id, flags, payload length
+HEADER = struct.Struct('!IBI')
+
+# Frame flags
+OPEN = 0x01
+DATA = 0x02
+CLOSE = 0x04
+WINDOW = 0x08
+
+# Bytes of DATA a stream can send ahead of the credit granted by its peer,
+# the payload of WINDOW frames being the credit granted
+WINDOW_SIZE = 262144
+CREDIT = struct.Struct('!I')
+
+
+def pack_frame(stream_id, flags, payload=b''):
+    return HEADER.pack(stream_id, flags, len(payload)) + payload
+
+
+def unpack_frames(data):
+    """Yield (stream_id, flags, payload) for every frame contained in a message"""
+    offset, size = 0, len(data)
+    while offset < size:
+        stream_id, flags, length = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        yield stream_id, flags, data[offset:offset + length]
+        offset += length
+
+
+class FrameSender:
+
+    """Queue of outgoing frames, all the frames queued while a message is being sent are joined
+    into the next one, up to max_size bytes. Producers are paused through the flow control
+    while too many bytes are waiting to be sent"""
+
+    def __init__(self, max_size=65536, high_watermark=HIGH_WATERMARK,
+                 low_watermark=LOW_WATERMARK):
+        self.max_size = max_size
+        self.queue = asyncio.Queue()
+        self.flow = FlowControl(high_watermark, low_watermark)
+
+    def send(self, stream_id, flags, payload=b''):
+        frame = pack_frame(stream_id, flags, payload)
+        self.queue.put_nowait(frame)
+        self.flow.add(len(frame))
+
+    def clear(self):
+        while not self.queue.empty():
+            self.flow.remove(len(self.queue.get_nowait()))
+
+    async def run(self, ws):
+        while not ws.closed:
+            frame = await self.queue.get()
+            batch, size = [frame], len(frame)
+            while size < self.max_size and not self.queue.empty():
+                frame = self.queue.get_nowait()
+                batch.append(frame)
+                size += len(frame)
+            self.flow.remove(size)
+            await ws.send_bytes(b''.join(batch))
+
+
+class Multiplexer:
+
+    """Client side of the multiplexed transport, carries all the local connections of the
+    tunnel process over one WebSocket to tunneld, reconnecting it when lost.
+
+    Streams are bound to a protocol exposing a transport, DATA frames are written through it,
+    WINDOW frames handed to it and a CLOSE frame closes its transport. With a balancer the WebSocket is opened with the best server
+    available at every reconnection."""
+
+    def __init__(self, url, session, max_size=65536, high_watermark=HIGH_WATERMARK,
+                 low_watermark=LOW_WATERMARK, balancer=None):
+        self.server_url = url
+        self.url = f'{url}/mux'
+        self.balancer = balancer
+        self.session = session
+        self.streams = {}
+        self.next_id = 1
+        self.sender = FrameSender(max_size, high_watermark, low_watermark)
+        self.logger = logging.getLogger('aiotunnel.mux.Multiplexer')
+
+    def open_stream(self, protocol, remote_host):
+        stream_id = self.next_id
+        self.next_id += 1
+        self.streams[stream_id] = protocol
+        protocol.credit = WINDOW_SIZE
+        self.sender.send(stream_id, OPEN, remote_host.encode())
+        return stream_id
+
+    def send(self, stream_id, data):
+        self.sender.send(stream_id, DATA, data)
+        metrics.BYTES_OUT.inc(len(data))
+        metrics.CHUNKS_OUT.inc()
+
+    def grant(self, stream_id, size):
+        """Let the peer send size more bytes of the stream"""
+        self.sender.send(stream_id, WINDOW, CREDIT.pack(size))
+
+    def close_stream(self, stream_id):
+        if self.streams.pop(stream_id, None) is not None:
+            self.sender.send(stream_id, CLOSE)
+
+    def close_all_streams(self):
+        streams, self.streams = self.streams, {}
+        for protocol in streams.values():
+            protocol.transport.close()
+
+    async def run(self):
+        while True:
+            if self.balancer:
+                self.server_url = (await self.balancer.place())[0].url
+                self.url = f'{self.server_url}/mux'
+            try:
+                async with self.session.ws_connect(self.url) as ws:
+                    self.logger.info("Multiplexing connections over %s", self.url)
+                    sender = asyncio.get_running_loop().create_task(self.sender.run(ws))
+                    try:
+                        await self.receive(ws)
+                    finally:
+                        sender.cancel()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.logger.debug("Cannot communicate with %s", self.url)
+                metrics.HTTP_ERRORS.inc()
+                if self.balancer:
+                    self.balancer.failed(self.server_url)
+            metrics.RETRIES.inc()
+            # Streams can't survive the loss of the WebSocket
+            self.close_all_streams()
+            self.sender.clear()
+            await asyncio.sleep(1)
+
+    async def receive(self, ws):
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                continue
+            for stream_id, flags, payload in unpack_frames(msg.data):
+                protocol = self.streams.get(stream_id)
+                if protocol is None:
+                    continue
+                if flags & DATA:
+                    protocol.write(payload)
+                    metrics.BYTES_IN.inc(len(payload))
+                    metrics.CHUNKS_IN.inc()
+                if flags & WINDOW:
+                    protocol.window_update(CREDIT.unpack(payload)[0])
+                if flags & CLOSE:
+                    del self.streams[stream_id]
+                    protocol.transport.close()
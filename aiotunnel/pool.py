@@ -0,0 +1,148 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import logging
+from collections import deque
+
+import aiohttp
+
+from . import metrics, compression
+from .protocol import Backoff
+
+POOL_SIZE = metrics.Gauge('aiotunnel_pool_tunnels', 'Tunnels opened in advance, ready to use')
+POOL_HITS = metrics.Counter('aiotunnel_pool_requests_total',
+                            'Connections served by the tunnel pool, by outcome', ('outcome',))
+POOL_HIT = POOL_HITS.labels('hit')
+POOL_MISS = POOL_HITS.labels('miss')
+
+# Open pools, one per forwarding, the gauge adding up their tunnels
+POOLS = set()
+POOL_SIZE.set_function(lambda: sum(len(pool.ready) for pool in POOLS))
+
+
+class TunnelPool:
+
+    """Keep size tunnels to remote_host opened in advance, refilled in background with bulk
+    POSTs, so that accepted connections skip the round trip opening theirs. Tunnels unused for
+    ttl seconds are closed and replaced before the server or the target expire them. With a
+    balancer every batch is opened on the best server available"""
+
+    def __init__(self, url, session, remote_host, size, ttl, compression=False, balancer=None):
+        self.url = url
+        self.balancer = balancer
+        self.session = session
+        self.remote_host = remote_host
+        self.size = size
+        self.ttl = ttl
+        self.compression = compression
+        # (cid, compressed, url, opened at), most recent on the right
+        self.ready = deque()
+        self.refill = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.logger = logging.getLogger('aiotunnel.pool.TunnelPool')
+        POOLS.add(self)
+
+    def take(self):
+        """Return the (cid, compressed, url) of the most recently opened tunnel, None if the
+        pool is empty"""
+        self.refill.set()
+        now = self.loop.time()
+        while self.ready:
+            cid, compressed, url, opened = self.ready.pop()
+            if now - opened < self.ttl:
+                POOL_HIT.inc()
+                return cid, compressed, url
+            self.loop.create_task(self.discard(cid, url))
+        POOL_MISS.inc()
+        return None
+
+    async def open_tunnels(self, count):
+        url = self.url
+        options = {}
+        if self.balancer:
+            url = (await self.balancer.place())[0].url
+            options['timeout'] = self.balancer.timeout
+        headers = {compression.HEADER: compression.CODEC} if self.compression else None
+        params = {'count': str(count), 'mode': 'forward'}
+        start = self.loop.time()
+        try:
+            async with self.session.post(url, data=self.remote_host.encode(),
+                                         params=params, headers=headers, **options) as resp:
+                resp.raise_for_status()
+                cids = (await resp.text()).split('\n')
+                compressed = resp.headers.get(compression.HEADER) == compression.CODEC
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if self.balancer and getattr(e, 'status', None) != 502:
+                self.balancer.failed(url)
+            raise
+        opened = self.loop.time()
+        if self.balancer:
+            self.balancer.placed(url, opened - start, len(cids))
+        self.ready.extendleft((cid, compressed, url, opened) for cid in cids)
+
+    async def discard(self, cid, url):
+        try:
+            async with self.session.delete(f'{url}/{cid}'):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.HTTP_ERRORS.inc()
+
+    async def run(self):
+        backoff = Backoff(float('inf'))
+        while True:
+            now = self.loop.time()
+            while self.ready and now - self.ready[0][3] >= self.ttl:
+                cid, _, url, _ = self.ready.popleft()
+                self.loop.create_task(self.discard(cid, url))
+            missing = self.size - len(self.ready)
+            if missing > 0:
+                try:
+                    await self.open_tunnels(missing)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.logger.debug("Cannot fill the pool: %s", str(e))
+                    metrics.HTTP_ERRORS.inc()
+                    await backoff.wait()
+                else:
+                    backoff.reset()
+                continue
+            self.refill.clear()
+            try:
+                # Wake up to replace the oldest tunnel before it expires
+                await asyncio.wait_for(self.refill.wait(),
+                                       self.ready[0][3] + self.ttl - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        POOLS.discard(self)
+        while self.ready:
+            cid, _, url, _ = self.ready.pop()
+            await self.discard(cid, url)
@@ -29,29 +29,290 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import socket
+import random
 import asyncio
 import logging
+from collections import deque
 
 import aiohttp
 
+from . import CONFIG, metrics, compression, tracing
+from .buffers import BUFFERS, BufferReader
 
-class BaseTunnelProtocol(asyncio.Protocol):
+# Write coalescing flush reasons:
+# - size: the batch reached the max size
+# - drained: nothing more queued and no flush delay set
+# - delay: the flush delay expired waiting for more data
+FLUSH_SIZE = metrics.WRITE_FLUSHES.labels('size')
+FLUSH_DRAINED = metrics.WRITE_FLUSHES.labels('drained')
+FLUSH_DELAY = metrics.WRITE_FLUSHES.labels('delay')
+WRITE_QUEUE_DEPTH = metrics.QUEUE_DEPTH.labels('write')
+
+# Default buffering limits in bytes, per connection and direction
+HIGH_WATERMARK = 262144
+LOW_WATERMARK = 65536
+
+# Sequence number of the chunks uploaded by PUT, letting tunneld put back in
+# order concurrent requests and drop the retransmitted ones
+SEQ_HEADER = 'X-Aiotunnel-Seq'
+
+# Bytes received by the client so far, sent along every GET: tunneld drops
+# the responses acknowledged and sends again the ones lost on the way, from
+# the offset echoed back in the response
+ACK_HEADER = 'X-Aiotunnel-Ack'
+OFFSET_HEADER = 'X-Aiotunnel-Offset'
+
+# Delay before retrying a failed request, doubled at every attempt
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5
+
+
+class Backoff:
+
+    """Exponential backoff with full jitter, giving up once timeout seconds passed since the
+    first failure"""
+
+    def __init__(self, timeout, delay=RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+        self.timeout = timeout
+        self.initial_delay = delay
+        self.max_delay = max_delay
+        self.reset()
+
+    def reset(self):
+        self.delay = self.initial_delay
+        self.deadline = None
+
+    async def wait(self):
+        """Sleep before the next attempt, return False if it's time to give up"""
+        now = asyncio.get_running_loop().time()
+        if self.deadline is None:
+            self.deadline = now + self.timeout
+        elif now >= self.deadline:
+            return False
+        metrics.RETRIES.inc()
+        await asyncio.sleep(random.uniform(0, self.delay))
+        self.delay = min(self.delay * 2, self.max_delay)
+        return True
+
+
+class Flag:
+
+    """asyncio.Event holding no waiters container until waited on, cheap enough to keep a few
+    for every idle connection"""
+
+    __slots__ = ('value', 'waiters')
+
+    def __init__(self, value=False):
+        self.value = value
+        self.waiters = None
+
+    def is_set(self):
+        return self.value
+
+    def set(self):
+        if self.value:
+            return
+        self.value = True
+        if self.waiters:
+            for waiter in self.waiters:
+                if not waiter.done():
+                    waiter.set_result(True)
+
+    def clear(self):
+        self.value = False
+
+    async def wait(self):
+        if self.value:
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        if self.waiters is None:
+            self.waiters = []
+        self.waiters.append(waiter)
+        try:
+            await waiter
+            return True
+        finally:
+            self.waiters.remove(waiter)
+            if not self.waiters:
+                self.waiters = None
+
+
+class ChunkQueue:
+
+    """Unbounded FIFO with the asyncio.Queue methods used by the tunnels, its items and
+    waiters containers created on demand and dropped once drained, so that an idle queue costs
+    no more than its slots"""
+
+    __slots__ = ('items', 'getters', 'unfinished', 'finished')
 
     def __init__(self):
+        self.items = None
+        self.getters = None
+        self.unfinished = 0
+        self.finished = None
+
+    def qsize(self):
+        return len(self.items) if self.items else 0
+
+    def empty(self):
+        return not self.items
+
+    def put_nowait(self, item):
+        if self.items is None:
+            self.items = deque()
+        self.items.append(item)
+        self.unfinished += 1
+        if self.finished is not None:
+            self.finished.clear()
+        self.wakeup_next()
+
+    def wakeup_next(self):
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+        if not self.getters:
+            self.getters = None
+
+    def get_nowait(self):
+        if not self.items:
+            raise asyncio.QueueEmpty()
+        item = self.items.popleft()
+        if not self.items:
+            self.items = None
+        return item
+
+    async def get(self):
+        while not self.items:
+            getter = asyncio.get_running_loop().create_future()
+            if self.getters is None:
+                self.getters = deque()
+            self.getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()
+                if self.getters and getter in self.getters:
+                    self.getters.remove(getter)
+                    if not self.getters:
+                        self.getters = None
+                # Woken up but cancelled, let the next getter have the item
+                elif self.items and not getter.cancelled():
+                    self.wakeup_next()
+                raise
+        return self.get_nowait()
+
+    def task_done(self):
+        self.unfinished -= 1
+        if not self.unfinished and self.finished is not None:
+            self.finished.set()
+
+    async def join(self):
+        if self.unfinished:
+            if self.finished is None:
+                self.finished = Flag()
+            await self.finished.wait()
+
+
+class FlowControl:
+
+    """Byte accounting of a buffer sitting between producers and a consumer.
+
+    Once the buffered bytes reach the high watermark the registered transports are paused and
+    the writable event cleared, they're resumed once the consumer drains the buffer down to the
+    low watermark."""
+
+    __slots__ = ('high_watermark', 'low_watermark', 'size', 'paused', 'transports', 'writable')
+
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.size = 0
+        self.paused = False
+        # Mostly a single one, a list is lighter than a set
+        self.transports = []
+        self.writable = Flag(True)
+
+    def register(self, transport):
+        if transport not in self.transports:
+            self.transports.append(transport)
+        if self.paused:
+            transport.pause_reading()
+
+    def unregister(self, transport):
+        if transport in self.transports:
+            self.transports.remove(transport)
+
+    def add(self, size):
+        self.size += size
+        if not self.paused and self.size >= self.high_watermark:
+            self.paused = True
+            self.writable.clear()
+            for transport in self.transports:
+                transport.pause_reading()
+
+    def remove(self, size):
+        self.size -= size
+        if self.paused and self.size <= self.low_watermark:
+            self.paused = False
+            self.writable.set()
+            for transport in self.transports:
+                if not transport.is_closing():
+                    transport.resume_reading()
+
+
+class BaseTunnelProtocol(asyncio.BufferedProtocol):
+
+    """Reads land in pooled buffers, data_received gets every chunk read as a memoryview which
+    must be released through BUFFERS.release once consumed"""
+
+    __slots__ = ('loop', 'transport', 'reader', 'high_watermark', 'low_watermark',
+                 '_shutdown', '_can_write', 'logger')
+
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK):
         self.loop = asyncio.get_running_loop()
         self.transport = None
-        self._shutdown = asyncio.Event()
+        self.reader = BufferReader(BUFFERS)
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self._shutdown = Flag()
+        self._can_write = Flag(True)
         self.logger = logging.getLogger('aiotunnel.protocol.BaseTunnelProtocol')
 
     def connection_made(self, transport):
         self.transport = transport
-        self.transport.set_write_buffer_limits(0)
+        self.transport.set_write_buffer_limits(self.high_watermark, self.low_watermark)
         sock = transport.get_extra_info('socket')
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if CONFIG['loop']['rcvbuf']:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CONFIG['loop']['rcvbuf'])
+        if CONFIG['loop']['sndbuf']:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CONFIG['loop']['sndbuf'])
+        metrics.TUNNELS_ACTIVE.inc()
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.data_received(self.reader.buffer_updated(nbytes))
+
+    def data_received(self, data):
+        raise NotImplementedError
+
+    def pause_writing(self):
+        # The peer is slower than us, stop pulling data to write until the
+        # transport buffer drains
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
 
     def connection_lost(self, exc):
         self.logger.debug('The server closed the connection')
+        metrics.TUNNELS_ACTIVE.dec()
         self.transport.close()
+        self.close()
 
     def eof_received(self):
         self.logger.debug('No more data to receive')
@@ -59,51 +320,228 @@ class BaseTunnelProtocol(asyncio.Protocol):
 
     def close(self):
         self._shutdown.set()
+        self._can_write.set()
 
 
 class TunnelProtocol(BaseTunnelProtocol):
 
-    def __init__(self, channel):
+    """Target connection of a tunneld channel, writing the requests pushed to it by a consumer
+    task started as they come in and gone once they're all written, idle tunnels having none"""
+
+    __slots__ = ('channel', 'close_channel', 'consumer')
+
+    def __init__(self, channel, close_channel=False):
         self.channel = channel
+        self.close_channel = close_channel
+        self.consumer = None
         self.logger = logging.getLogger('aiotunnel.protocol.TunnelProtocol')
-        super().__init__()
+        super().__init__(channel.res_flow.high_watermark, channel.res_flow.low_watermark)
 
     def connection_made(self, transport):
         super().connection_made(transport)
-        self.loop.create_task(self.async_consume_request())
+        self.channel.res_flow.register(transport)
+        self.channel.target = self
+        self.wakeup()
+
+    def wakeup(self):
+        """Make sure the requests queued get written"""
+        if self.transport is None or self._shutdown.is_set() or self.channel.req.empty():
+            return
+        if self.consumer is None or self.consumer.done():
+            self.consumer = self.loop.create_task(self.async_consume_request())
+
+    def connection_lost(self, exc):
+        # Stop consuming right away, the requests left must not be lost to a
+        # closed transport
+        if self.consumer is not None:
+            self.consumer.cancel()
+        if self.channel.target is self:
+            self.channel.target = None
+        self.channel.res_flow.unregister(self.transport)
+        # Let the reading side know that no more data will come
+        if self.close_channel:
+            self.channel.close()
+        super().connection_lost(exc)
 
     def data_received(self, data):
-        self.loop.create_task(self.channel.push_response(data))
+        self.channel.push_response_nowait(data)
 
     async def async_consume_request(self):
-        while not self._shutdown.is_set():
+        while not self._shutdown.is_set() and not self.channel.req.empty():
             try:
+                await self._can_write.wait()
                 request = await self.channel.pull_request()
             except asyncio.CancelledError:
                 self.logger.debug("Closing")
                 self.close()
             else:
                 self.transport.write(request)
+                if self.channel.req_traces:
+                    tracing.finish_all(self.channel.req_traces, 'write')
+                    self.channel.req_traces = ()
+
+
+class MuxTunnelProtocol(BaseTunnelProtocol):
+
+    """Local connection carried as a stream of a shared mux.Multiplexer, no HTTP calls of its
+    own. Reading stops once the credit granted by tunneld is spent and tunneld gets credit back
+    for the data written only while the local peer keeps up"""
+
+    __slots__ = ('remote_host', 'multiplexer', 'stream_id', 'credit', 'withheld')
+
+    def __init__(self, remote_host, multiplexer):
+        self.remote_host = remote_host
+        self.multiplexer = multiplexer
+        self.stream_id = None
+        # Bytes that can still be sent, set as the stream opens, and bytes
+        # written not credited yet
+        self.credit = 0
+        self.withheld = 0
+        self.logger = logging.getLogger('aiotunnel.protocol.MuxTunnelProtocol')
+        super().__init__()
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.multiplexer.sender.flow.register(transport)
+        self.stream_id = self.multiplexer.open_stream(self, self.remote_host)
+
+    def data_received(self, data):
+        # Framing copies the data already
+        self.credit -= len(data)
+        self.multiplexer.send(self.stream_id, data)
+        BUFFERS.release(data)
+        if self.credit <= 0:
+            # Out of the WebSocket flow control until tunneld grants more
+            self.multiplexer.sender.flow.unregister(self.transport)
+            self.transport.pause_reading()
+
+    def window_update(self, size):
+        paused = self.credit <= 0
+        self.credit += size
+        if paused and self.credit > 0 and not self.transport.is_closing():
+            flow = self.multiplexer.sender.flow
+            flow.register(self.transport)
+            if not flow.paused:
+                self.transport.resume_reading()
+
+    def write(self, data):
+        self.transport.write(data)
+        self.withheld += len(data)
+        if self._can_write.is_set():
+            self.multiplexer.grant(self.stream_id, self.withheld)
+            self.withheld = 0
+
+    def resume_writing(self):
+        super().resume_writing()
+        if self.withheld and self.stream_id in self.multiplexer.streams:
+            self.multiplexer.grant(self.stream_id, self.withheld)
+            self.withheld = 0
+
+    def connection_lost(self, exc):
+        self.multiplexer.sender.flow.unregister(self.transport)
+        self.multiplexer.close_stream(self.stream_id)
+        super().connection_lost(exc)
 
 
 class LocalTunnelProtocol(BaseTunnelProtocol):
 
-    def __init__(self, remote_host, url, on_conn_lost=None, ssl_context=None):
-        self.cid = None
+    """Carry a local connection over HTTP, opening the remote connection with a POST unless a
+    cid is given, as for the connections accepted by a reverse endpoint, in which case
+    compression tells if it's been negotiated already. With a balancer the POST goes to the
+    best server available, url being the one the cid is pinned to"""
+
+    __slots__ = ('cid', 'url', 'balancer', 'remote_host', 'session', 'mode', 'max_batch_size',
+                 'flush_delay', 'compression', 'compression_level', 'compression_threshold',
+                 'compressor', 'write_queue', 'write_flow', 'write_window', 'resume_timeout',
+                 'received', 'write_seq', 'in_flight', 'batching', 'window_open', 'writes_idle',
+                 'acked_writes', 'writer', 'poller', 'tracer', 'batch_traces', 'on_conn_lost',
+                 '__weakref__')
+
+    def __init__(self, remote_host, url, session, on_conn_lost=None, mode='rest',
+                 max_batch_size=65536, flush_delay=0, compression=False, compression_level=6,
+                 compression_threshold=1024, cid=None, write_window=4, resume_timeout=60,
+                 balancer=None, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK):
+        self.cid = cid
         self.url = url
+        self.balancer = balancer
         self.remote_host = remote_host
-        self.write_queue = asyncio.Queue()
+        self.session = session
+        self.mode = mode
+        self.max_batch_size = max_batch_size
+        # Microseconds to wait for more data before sending a batch
+        self.flush_delay = flush_delay / 1e6
+        # Requested unless cid is given, negotiated otherwise, only the message
+        # oriented transports can carry compressed chunks
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold
+        # Set once the server accepts compression
+        self.compressor = None
+        self.write_queue = ChunkQueue()
+        self.write_flow = FlowControl(high_watermark, low_watermark)
+        # Concurrent PUTs, each one keeping its chunk to retransmit it until
+        # acknowledged by the server
+        self.write_window = write_window
+        # Seconds to keep retrying while the server can't be reached, the
+        # connection being resumed as it's back
+        self.resume_timeout = resume_timeout
+        # Bytes received by GET so far
+        self.received = 0
+        self.write_seq = 0
+        self.in_flight = 0
+        # True while the writer coalesces a batch, dequeued but not in flight
+        self.batching = False
+        # Set while less than write_window PUTs are in flight
+        self.window_open = Flag(True)
+        # Set while nothing is queued, batched nor in flight, closing the remote
+        # connection waits for it not to lose the last chunks
+        self.writes_idle = Flag(True)
+        # Set once the rest transport started, the task sending the queued
+        # data being started as it comes in and gone once it's all sent
+        self.acked_writes = False
+        self.writer = None
+        # Task long polling the server with the rest transport
+        self.poller = None
+        # Follows the sampled chunks through the write queue, None unless
+        # tracing is enabled, and the traces of the last batch dequeued
+        self.tracer = tracing.queue_tracer()
+        self.batch_traces = ()
         self.on_conn_lost = on_conn_lost
-        self.ssl_context = ssl_context
         self.logger = logging.getLogger('aiotunnel.protocol.LocalTunnelProtocol')
-        super().__init__()
+        super().__init__(high_watermark, low_watermark)
 
     def connection_made(self, transport):
         super().connection_made(transport)
-        self.loop.create_task(self.async_open_remote_connection())
+        self.write_flow.register(transport)
+        if self.cid is None:
+            self.loop.create_task(self.async_open_remote_connection())
+            return
+        if self.compression:
+            if self.mode not in compression.TRANSPORTS:
+                # The server would send compressed chunks we can't tell apart
+                self.logger.error("Compression negotiated for %s can't be carried over %s, "
+                                  "closing", self.cid, self.mode)
+                self.loop.create_task(self.async_close_remote_connection())
+                self.transport.close()
+                return
+            self.compressor = compression.Compressor(self.compression_level,
+                                                     self.compression_threshold)
+        self.start_data()
 
     def data_received(self, data):
         self.write_queue.put_nowait(data)
+        self.write_flow.add(len(data))
+        if self.tracer:
+            self.tracer.put(len(data), tracing.sample('client', 'up', self.cid, len(data)))
+        self.writes_idle.clear()
+        WRITE_QUEUE_DEPTH.inc()
+        self.wakeup_writer()
+
+    def wakeup_writer(self):
+        if not self.acked_writes or self.write_queue.empty():
+            return
+        if self.writer is None or self.writer.done():
+            self.writer = self.loop.create_task(self.async_write_data())
 
     def eof_received(self):
         self.loop.create_task(self.async_close_remote_connection())
@@ -111,60 +549,329 @@ class LocalTunnelProtocol(BaseTunnelProtocol):
             self.on_conn_lost.set_result(True)
         super().eof_received()
 
+    def server_succeeded(self):
+        if self.balancer:
+            self.balancer.succeeded(self.url)
+
+    def server_failed(self, url=None):
+        if self.balancer:
+            self.balancer.failed(url or self.url)
+
     async def async_open_remote_connection(self):
         remote = self.remote_host.encode()
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.url, data=remote, ssl_context=self.ssl_context) as resp:
-                    cid = await resp.text()
-        except (aiohttp.ClientError, asyncio.TimeoutError):
-            self.logger.debug("Cannot communicate with %s", self.url)
-            await asyncio.sleep(5)
-        except:
-            self.logger.debug("Connection with server lost")
-            await asyncio.sleep(5)
+        headers = None
+        if self.compression and self.mode in compression.TRANSPORTS:
+            headers = {compression.HEADER: compression.CODEC}
+        options = {}
+        if self.balancer:
+            urls = [server.url for server in self.balancer.candidates()]
+            options['timeout'] = self.balancer.timeout
         else:
+            urls = [self.url]
+        # Fail over to the next server until one opens the tunnel
+        for url in urls:
+            start = self.loop.time()
+            try:
+                async with self.session.post(url, data=remote, params={'mode': 'forward'},
+                                             headers=headers, **options) as resp:
+                    resp.raise_for_status()
+                    cid = await resp.text()
+                    if resp.headers.get(compression.HEADER) == compression.CODEC:
+                        self.compressor = compression.Compressor(self.compression_level,
+                                                                 self.compression_threshold)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.debug("Cannot open a tunnel with %s: %s", url, str(e))
+                metrics.HTTP_ERRORS.inc()
+                # Not the server's fault if it couldn't reach the target
+                if getattr(e, 'status', None) != 502:
+                    self.server_failed(url)
+                continue
+            except:
+                self.logger.debug("Connection with server lost")
+                metrics.CONNECTION_LOST_ERRORS.inc()
+                break
+            if self.balancer:
+                self.balancer.placed(url, self.loop.time() - start)
+            self.url = url
             self.cid = cid
-            scheme = 'HTTPS' if self.ssl_context else 'HTTP'
+            scheme = 'HTTPS' if self.url.startswith('https') else 'HTTP'
             self.logger.info("%s over %s to %s", self.remote_host, scheme, self.url)
             self.logger.info("Obtained a client id: %s", cid)
-            self.loop.create_task(self.async_write_data())
-            self.loop.create_task(self.async_read_data())
+            self.start_data()
+            return
+        self.logger.error("Unable to open a tunnel to %s", self.remote_host)
+        self.transport.close()
+
+    def start_data(self):
+        if self.mode == 'ws':
+            self.loop.create_task(self.async_ws_data())
+        elif self.mode == 'stream':
+            self.loop.create_task(self.async_stream_data())
+        else:
+            self.start_rest_data()
+
+    def start_rest_data(self):
+        self.acked_writes = True
+        # Send what's been read while opening the tunnel
+        self.wakeup_writer()
+        self.poller = self.loop.create_task(self.async_read_data())
+
+    def close(self):
+        super().close()
+        # Nothing left to read for, the writer is only let finish sending
+        # what's been queued before the local side closed
+        if self.poller is not None:
+            self.poller.cancel()
+        if self.writer is not None and self.writes_idle.is_set():
+            self.writer.cancel()
 
     async def async_close_remote_connection(self):
+        if self.acked_writes:
+            await self.writes_idle.wait()
         try:
-            async with aiohttp.ClientSession() as session:
-                await session.delete(f'{self.url}/{self.cid}', ssl_context=self.ssl_context)
+            async with self.session.delete(f'{self.url}/{self.cid}'):
+                pass
         except (aiohttp.ClientError, asyncio.TimeoutError):
+            # The server expires the tunnel anyway once idle
             self.logger.debug("Cannot communicate with %s", self.url)
-            await asyncio.sleep(5)
+            metrics.HTTP_ERRORS.inc()
+            self.server_failed()
         except:
             self.logger.debug("Connection with server lost")
-            await asyncio.sleep(5)
+            metrics.CONNECTION_LOST_ERRORS.inc()
+
+    async def next_batch(self):
+        """Wait for data to send and coalesce everything queued into a single payload, up to
+        max_batch_size bytes, waiting at most flush_delay for more data to arrive when the queue
+        is drained early"""
+        data = await self.write_queue.get()
+        batch, size = [data], len(data)
+        deadline = self.loop.time() + self.flush_delay
+        flush = FLUSH_SIZE
+        while size < self.max_batch_size:
+            if not self.write_queue.empty():
+                data = self.write_queue.get_nowait()
+            elif not self.flush_delay:
+                flush = FLUSH_DRAINED
+                break
+            else:
+                try:
+                    data = await asyncio.wait_for(self.write_queue.get(),
+                                                  deadline - self.loop.time())
+                except asyncio.TimeoutError:
+                    flush = FLUSH_DELAY
+                    break
+            batch.append(data)
+            size += len(data)
+        self.write_flow.remove(size)
+        if self.tracer:
+            self.batch_traces = self.tracer.get(size, 'queue')
+        WRITE_QUEUE_DEPTH.dec(len(batch))
+        flush.inc()
+        metrics.WRITE_BATCH_SIZE.observe(size)
+        metrics.BYTES_OUT.inc(size)
+        metrics.CHUNKS_OUT.inc()
+        # The only copy of the data read, the chunks are free to be reused
+        data = b''.join(batch)
+        for chunk in batch:
+            BUFFERS.release(chunk)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        return data
 
     async def async_write_data(self):
-        while not self._shutdown.is_set():
-            data = await self.write_queue.get()
+        # Keep sending what's been read before the local side closed
+        while not self.write_queue.empty():
+            while self.in_flight >= self.write_window:
+                self.window_open.clear()
+                await self.window_open.wait()
+            self.batching = True
             try:
-                async with aiohttp.ClientSession() as session:
-                    await session.put(f'{self.url}/{self.cid}', data=data, ssl_context=self.ssl_context)
-            except (aiohttp.ClientError, asyncio.TimeoutError):
-                self.logger.debug("Cannot communicate with %s", self.url)
-                await asyncio.sleep(5)
-            except:
-                self.logger.debug("Connection with server lost")
-                self.close()
+                data = await self.next_batch()
+            finally:
+                self.batching = False
+            self.in_flight += 1
+            self.loop.create_task(self.async_put_chunk(self.write_seq, data, self.batch_traces))
+            self.batch_traces = ()
+            self.write_seq += 1
+
+    async def async_put_chunk(self, seq, data, traces=()):
+        """PUT a chunk until acknowledged, retrying with an exponential backoff"""
+        headers = {SEQ_HEADER: str(seq)}
+        if traces:
+            # The server carries on with the first one
+            headers[tracing.TRACE_HEADER] = traces[0].trace_id
+        backoff = Backoff(self.resume_timeout)
+        try:
+            while True:
+                try:
+                    async with self.session.put(f'{self.url}/{self.cid}', data=data,
+                                                headers=headers) as resp:
+                        if resp.status in (404, 410):
+                            self.logger.debug("Connection %s closed by the server", self.cid)
+                            self.transport.close()
+                            return
+                        if resp.status < 300:
+                            self.server_succeeded()
+                            tracing.finish_all(traces, 'http')
+                            return
+                        # The server reorder window is full
+                        self.logger.debug("Chunk %s of %s refused with %s",
+                                          seq, self.cid, resp.status)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    self.logger.debug("Cannot communicate with %s", self.url)
+                    metrics.HTTP_ERRORS.inc()
+                    self.server_failed()
+                if not await backoff.wait():
+                    break
+            self.logger.error("Chunk %s of %s not acknowledged after %s seconds, closing",
+                              seq, self.cid, self.resume_timeout)
+            self.transport.close()
+        except:
+            self.logger.debug("Connection with server lost")
+            metrics.CONNECTION_LOST_ERRORS.inc()
+            self.close()
+        finally:
+            self.in_flight -= 1
+            self.window_open.set()
+            if not self.in_flight and not self.batching and self.write_queue.empty():
+                self.writes_idle.set()
+                if self._shutdown.is_set() and self.writer is not None:
+                    self.writer.cancel()
 
     async def async_read_data(self):
+        backoff = Backoff(self.resume_timeout)
         while not self._shutdown.is_set():
+            await self._can_write.wait()
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(f'{self.url}/{self.cid}', ssl_context=self.ssl_context) as resp:
-                        data = await resp.read()
-                        self.transport.write(data)
+                headers = {ACK_HEADER: str(self.received)}
+                async with self.session.get(f'{self.url}/{self.cid}', headers=headers) as resp:
+                    if resp.status in (404, 410):
+                        self.logger.debug("Connection %s closed by the server", self.cid)
+                        self.transport.close()
+                        break
+                    if resp.status == 204:
+                        # Long poll timed out, nothing to read
+                        backoff.reset()
+                        continue
+                    data = await resp.read()
+                    offset = int(resp.headers.get(OFFSET_HEADER, self.received))
+                    trace_id = resp.headers.get(tracing.TRACE_HEADER)
+                trace = trace_id and tracing.Trace('client', 'down', self.cid, len(data), trace_id)
+                backoff.reset()
+                self.server_succeeded()
+                if self.compressor:
+                    data = compression.decompress(data)
+                if offset > self.received:
+                    self.logger.error("Lost data of %s at offset %s", self.cid, self.received)
+                    self.transport.close()
+                    break
+                # Skip what's already been received of a response sent again
+                data = data[self.received - offset:]
+                self.received += len(data)
+                self.transport.write(data)
+                if trace:
+                    trace.finish('write')
+                metrics.BYTES_IN.inc(len(data))
+                metrics.CHUNKS_IN.inc()
             except (aiohttp.ClientError, asyncio.TimeoutError):
                 self.logger.debug("Cannot communicate with %s", self.url)
-                await asyncio.sleep(5)
+                metrics.HTTP_ERRORS.inc()
+                self.server_failed()
+                if not await backoff.wait():
+                    self.logger.error("Cannot resume %s after %s seconds, closing",
+                                      self.cid, self.resume_timeout)
+                    self.transport.close()
+                    break
             except:
                 self.logger.debug("Connection with server lost")
+                metrics.CONNECTION_LOST_ERRORS.inc()
                 self.close()
+
+    async def async_ws_data(self):
+        try:
+            ws = await self.session.ws_connect(f'{self.url}/{self.cid}/ws')
+        except aiohttp.WSServerHandshakeError:
+            # Probably a proxy stripping the Upgrade header, REST calls
+            # still work
+            self.logger.info("WebSocket refused by %s, falling back to REST", self.url)
+            self.start_rest_data()
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.logger.debug("Cannot communicate with %s", self.url)
+            metrics.HTTP_ERRORS.inc()
+            self.server_failed()
+            self.transport.close()
+            return
+        async with ws:
+            tasks = [
+                self.loop.create_task(self.async_ws_write(ws)),
+                self.loop.create_task(self.async_ws_read(ws)),
+                self.loop.create_task(self._shutdown.wait())
+            ]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+        self.transport.close()
+
+    async def async_ws_write(self, ws):
+        while not self._shutdown.is_set():
+            data = await self.next_batch()
+            await ws.send_bytes(data)
+            tracing.finish_all(self.batch_traces, 'send')
+
+    async def async_ws_read(self, ws):
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                data = msg.data
+                if self.compressor:
+                    data = compression.decompress(data)
+                self.transport.write(data)
+                metrics.BYTES_IN.inc(len(data))
+                metrics.CHUNKS_IN.inc()
+                await self._can_write.wait()
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                self.logger.debug("Connection with server lost")
+                metrics.CONNECTION_LOST_ERRORS.inc()
+                break
+
+    async def async_stream_data(self):
+        tasks = [
+            self.loop.create_task(self.async_stream_write()),
+            self.loop.create_task(self.async_stream_read()),
+            self.loop.create_task(self._shutdown.wait())
+        ]
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks:
+            task.cancel()
+        self.transport.close()
+
+    async def stream_write_queue(self):
+        while not self._shutdown.is_set():
+            yield await self.next_batch()
+
+    async def async_stream_write(self):
+        # A single chunked PUT, its body fed by the write queue for the whole
+        # life of the connection
+        timeout = aiohttp.ClientTimeout(total=None)
+        try:
+            async with self.session.put(f'{self.url}/{self.cid}',
+                                        data=self.stream_write_queue(), timeout=timeout):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.logger.debug("Cannot communicate with %s", self.url)
+            metrics.HTTP_ERRORS.inc()
+
+    async def async_stream_read(self):
+        timeout = aiohttp.ClientTimeout(total=None)
+        try:
+            async with self.session.get(f'{self.url}/{self.cid}',
+                                        params={'stream': '1'}, timeout=timeout) as resp:
+                async for data in resp.content.iter_any():
+                    self.transport.write(data)
+                    metrics.BYTES_IN.inc(len(data))
+                    metrics.CHUNKS_IN.inc()
+                    await self._can_write.wait()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.logger.debug("Cannot communicate with %s", self.url)
+            metrics.HTTP_ERRORS.inc()
@@ -0,0 +1,199 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+from collections import deque
+
+from . import metrics
+
+SCHEDULER_WAIT = metrics.Histogram('aiotunnel_scheduler_wait_seconds',
+                                   'Time tunneled data waited for the scheduler',
+                                   ('direction',))
+THROTTLED = metrics.Counter('aiotunnel_throttled_bytes_total',
+                            'Bytes delayed by a rate limit or the shared bandwidth',
+                            ('direction',))
+
+
+class TokenBucket:
+
+    """Rate limit of rate bytes per second, allowing bursts of up to burst bytes. Taking more
+    tokens than available leaves the bucket in debt, the caller waiting for it to be paid back
+    before sending, so chunks bigger than the burst still go through"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, size, now):
+        """Take size tokens, return the seconds to wait before using them"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Flow:
+
+    """Data of a tunnel waiting for the scheduler, with its deficit counter and rate limit"""
+
+    def __init__(self, client, bucket=None):
+        self.client = client
+        self.bucket = bucket
+        # (size, future) resolved once the data can be sent
+        self.waiting = deque()
+        self.deficit = 0
+        # In the round robin of the scheduler
+        self.active = False
+
+
+class Scheduler:
+
+    """Share one direction of the gateway among tunnels and clients.
+
+    Every tunnel and every client address can be limited to a rate with a token bucket, then
+    if bandwidth is set the tunnels take turns with deficit round robin: each one gets a
+    quantum of bytes per round, so that the small chunks of interactive tunnels are sent
+    right away and bulk transfers split the rest in fair shares instead of queueing ahead of
+    everyone else"""
+
+    def __init__(self, direction, bandwidth=0, quantum=16384, tunnel_rate=0,
+                 tunnel_burst=262144, client_rate=0, client_burst=1048576):
+        self.quantum = quantum
+        self.tunnel_rate = tunnel_rate
+        self.tunnel_burst = tunnel_burst
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.bandwidth = bandwidth
+        # Created on the first transmission, in the loop serving the tunnels
+        self.bucket = None
+        # Keyed by the channel of the tunnel
+        self.flows = {}
+        # Client address -> [bucket, number of flows]
+        self.clients = {}
+        # Flows with data waiting, in round robin order
+        self.active = deque()
+        self.dispatcher = None
+        self.wait_time = SCHEDULER_WAIT.labels(direction)
+        self.throttled = THROTTLED.labels(direction)
+
+    @classmethod
+    def from_config(cls, direction, conf):
+        """Return the scheduler configured in conf, None if it has nothing to enforce"""
+        if not (conf['bandwidth'] or conf['tunnel_rate'] or conf['client_rate']):
+            return None
+        return cls(direction, conf['bandwidth'], conf['quantum'], conf['tunnel_rate'],
+                   conf['tunnel_burst'], conf['client_rate'], conf['client_burst'])
+
+    @property
+    def max_chunk_size(self):
+        """Data sent at once by a tunnel, bigger chunks hold the others back for longer"""
+        return self.quantum * 4 if self.bandwidth else None
+
+    def flow(self, key, client, now):
+        flow = self.flows.get(key)
+        if flow is None:
+            bucket = None
+            if self.tunnel_rate:
+                bucket = TokenBucket(self.tunnel_rate, self.tunnel_burst, now)
+            flow = self.flows[key] = Flow(client, bucket)
+            if client in self.clients:
+                self.clients[client][1] += 1
+            elif self.client_rate:
+                bucket = TokenBucket(self.client_rate, self.client_burst, now)
+                self.clients[client] = [bucket, 1]
+        return flow
+
+    def forget(self, key):
+        flow = self.flows.pop(key, None)
+        if flow is None or flow.client not in self.clients:
+            return
+        self.clients[flow.client][1] -= 1
+        if not self.clients[flow.client][1]:
+            del self.clients[flow.client]
+
+    async def transmit(self, key, client, size):
+        """Wait for the turn of size bytes of the tunnel key, opened by client"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        flow = self.flow(key, client, start)
+        delay = 0
+        if flow.bucket:
+            delay = flow.bucket.take(size, start)
+        if client in self.clients:
+            delay = max(delay, self.clients[client][0].take(size, start))
+        if delay:
+            self.throttled.inc(size)
+            await asyncio.sleep(delay)
+        if self.bandwidth:
+            if self.bucket is None:
+                self.bucket = TokenBucket(self.bandwidth, max(self.quantum, self.tunnel_burst),
+                                          start)
+            # Big chunks take several turns, letting the other tunnels through
+            # in between
+            while size > 0:
+                piece = min(size, self.max_chunk_size)
+                size -= piece
+                await self.wait_turn(flow, piece)
+        self.wait_time.observe(loop.time() - start)
+
+    async def wait_turn(self, flow, size):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        flow.waiting.append((size, waiter))
+        if not flow.active:
+            flow.active = True
+            self.active.append(flow)
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = loop.create_task(self.dispatch())
+        await waiter
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self.active:
+            flow = self.active[0]
+            flow.deficit += self.quantum
+            while flow.waiting and flow.waiting[0][0] <= flow.deficit:
+                size, waiter = flow.waiting.popleft()
+                flow.deficit -= size
+                delay = self.bucket.take(size, loop.time())
+                if delay:
+                    self.throttled.inc(size)
+                    await asyncio.sleep(delay)
+                if not waiter.done():
+                    waiter.set_result(None)
+            self.active.popleft()
+            if flow.waiting:
+                self.active.append(flow)
+            else:
+                # An idle flow doesn't save up for later
+                flow.active = False
+                flow.deficit = 0
@@ -0,0 +1,136 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import ssl
+import time
+import logging
+
+from . import CONFIG, metrics
+
+HANDSHAKES = metrics.Counter('aiotunnel_tls_handshakes_total',
+                             'TLS handshakes completed, full or resuming a session',
+                             ('side', 'resumed'))
+HANDSHAKE_DURATION = metrics.Histogram('aiotunnel_tls_handshake_duration_seconds',
+                                       'Time to complete a TLS handshake, round trips included',
+                                       ('side',))
+
+VERSIONS = {
+    'TLSv1.2': ssl.TLSVersion.TLSv1_2,
+    'TLSv1.3': ssl.TLSVersion.TLSv1_3
+}
+
+logger = logging.getLogger(__name__)
+
+
+class TLSObject(ssl.SSLObject):
+
+    """SSL object of a connection, timing its handshake and handing the session to its context
+    as soon as it can be resumed"""
+
+    def do_handshake(self):
+        # Called again by the transport until the handshake completes
+        super().do_handshake()
+        side = 'server' if self.server_side else 'client'
+        HANDSHAKES.labels(side, 'yes' if self.session_reused else 'no').inc()
+        HANDSHAKE_DURATION.labels(side).observe(time.monotonic() - self.started)
+        self.context.keep_session(self)
+
+    def read(self, len=1024, buffer=None):
+        data = super().read(len, buffer)
+        if not self.session_kept:
+            self.context.keep_session(self)
+        return data
+
+
+class TLSContext(ssl.SSLContext):
+
+    """SSL context keeping the last session of every server, new client connections resuming
+    it to skip the full handshake. Sessions are kept per context, connections to different
+    servers or made with different contexts never share them"""
+
+    sslobject_class = TLSObject
+
+    def __init__(self, protocol, session_resumption=True):
+        self.session_resumption = session_resumption
+        # server hostname -> last resumable session
+        self.sessions = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None,
+                 session=None):
+        if session is None and not server_side and self.session_resumption:
+            session = self.sessions.get(server_hostname)
+        sslobj = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        sslobj.started = time.monotonic()
+        sslobj.session_kept = server_side or not self.session_resumption
+        return sslobj
+
+    def keep_session(self, sslobj):
+        session = sslobj.session
+        if session is None:
+            return
+        # TLSv1.3 tickets are sent after the handshake, along with the first
+        # data read
+        if sslobj.version() == 'TLSv1.3' and not session.has_ticket:
+            return
+        self.sessions[sslobj.server_hostname] = session
+        sslobj.session_kept = True
+
+
+def configure(context):
+    conf = CONFIG['tls']
+    context.minimum_version = VERSIONS[conf['min_version']]
+    # TLSv1.3 suites are all AEAD and not configurable, the list only
+    # applies to TLSv1.2
+    if conf['ciphers']:
+        context.set_ciphers(conf['ciphers'])
+
+
+def create_client_context(cafile, certfile=None, keyfile=None):
+    """Return the context of the HTTPS connections to the servers, verifying them against
+    cafile and resuming their sessions unless disabled in CONFIG['tls']"""
+    context = TLSContext(ssl.PROTOCOL_TLS_CLIENT, CONFIG['tls']['session_resumption'])
+    context.load_verify_locations(cafile)
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    configure(context)
+    return context
+
+
+def create_server_context(cafile, certfile, keyfile):
+    """Return the context of tunneld, issuing session tickets unless session resumption is
+    disabled in CONFIG['tls']. Forked workers share it, and with it the ticket keys, so a
+    session opened with a worker resumes with any other"""
+    context = TLSContext(ssl.PROTOCOL_TLS_SERVER, CONFIG['tls']['session_resumption'])
+    context.load_verify_locations(cafile)
+    context.load_cert_chain(certfile, keyfile)
+    if not context.session_resumption:
+        context.options |= ssl.OP_NO_TICKET
+    configure(context)
+    return context
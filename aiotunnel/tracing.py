@@ -0,0 +1,223 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import signal
+import logging
+import logging.handlers
+import cProfile
+from collections import deque
+
+from . import CONFIG, LogListener, metrics
+
+# Id of the trace of a chunk, sent along the PUT carrying it or the GET
+# response carrying a traced response, so both sides can be matched
+TRACE_HEADER = 'X-Aiotunnel-Trace'
+
+HOP_LATENCY = metrics.Histogram('aiotunnel_trace_hop_seconds',
+                                'Time sampled chunks spent in each hop of the tunnel',
+                                ('side', 'direction', 'hop'))
+
+logger = logging.getLogger(__name__)
+
+# The finished traces are queued as records of their own logger, kept out of
+# the log file, and written as JSON lines by the listener thread started by
+# setup_tracing
+trace_logger = logging.getLogger('aiotunnel.tracing.traces')
+trace_logger.propagate = False
+trace_listener = None
+
+
+class TraceHandler(logging.handlers.QueueHandler):
+
+    """Queue the records of the traces as they are, serializing them is left to the listener
+    thread"""
+
+    def prepare(self, record):
+        return record
+
+
+class TraceFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(record.msg)
+
+
+class Trace:
+
+    """Timestamps of a chunk along the hops of one side of the tunnel, the time spent in a hop
+    being the one between its mark and the previous one"""
+
+    __slots__ = ('trace_id', 'side', 'direction', 'cid', 'size', 'started', 'hops')
+
+    def __init__(self, side, direction, cid=None, size=0, trace_id=None):
+        self.trace_id = trace_id or f'{random.getrandbits(64):016x}'
+        self.side = side
+        self.direction = direction
+        self.cid = cid
+        self.size = size
+        self.started = time.time()
+        self.hops = [(None, time.monotonic())]
+
+    def mark(self, hop):
+        self.hops.append((hop, time.monotonic()))
+
+    def finish(self, hop):
+        self.mark(hop)
+        durations = {}
+        for (_, previous), (name, when) in zip(self.hops, self.hops[1:]):
+            durations[name] = when - previous
+            HOP_LATENCY.labels(self.side, self.direction, name).observe(when - previous)
+        if trace_listener:
+            trace_logger.info({
+                'trace': self.trace_id,
+                'side': self.side,
+                'direction': self.direction,
+                'cid': self.cid,
+                'size': self.size,
+                'start': self.started,
+                'hops_ms': {name: round(d * 1000, 3) for name, d in durations.items()}
+            })
+
+
+class QueueTracer:
+
+    """Follow the sampled chunks through a FIFO queue by their byte offset, without touching
+    the queued items"""
+
+    def __init__(self):
+        self.queued = 0
+        self.dequeued = 0
+        # (offset of the end of the chunk, trace)
+        self.pending = deque()
+
+    def put(self, size, trace=None):
+        self.queued += size
+        if trace:
+            self.pending.append((self.queued, trace))
+
+    def get(self, size, hop):
+        """Account for size bytes taken from the queue, return the traces of the chunks that
+        left it, marked with hop"""
+        self.dequeued += size
+        traces = []
+        while self.pending and self.pending[0][0] <= self.dequeued:
+            trace = self.pending.popleft()[1]
+            trace.mark(hop)
+            traces.append(trace)
+        return traces
+
+
+def enabled():
+    return CONFIG['tracing']['sample_rate'] > 0
+
+
+def queue_tracer():
+    """Return a QueueTracer if tracing is enabled, None otherwise, leaving the untraced
+    paths with a single check"""
+    return QueueTracer() if enabled() else None
+
+
+def sample(side, direction, cid=None, size=0):
+    """Start a trace for a chunk with probability sample_rate, return None if not sampled"""
+    if random.random() >= CONFIG['tracing']['sample_rate']:
+        return None
+    return Trace(side, direction, cid, size)
+
+
+def carry_on(headers, side, direction, cid=None, size=0):
+    """Continue on this side the trace started by the peer, if any and tracing is enabled
+    here too"""
+    trace_id = headers.get(TRACE_HEADER)
+    if not trace_id or not enabled():
+        return None
+    return Trace(side, direction, cid, size, trace_id)
+
+
+def finish_all(traces, hop):
+    for trace in traces:
+        trace.finish(hop)
+
+
+def stop_tracing():
+    """Write the traces still queued and stop the listener, forked workers must call it as they
+    exit without running the atexit handlers"""
+    if trace_listener:
+        trace_listener.stop()
+
+
+class Profiler:
+
+    """cProfile toggled by a signal: the first one starts profiling the process, the next one
+    stops it and dumps the stats in directory, to be read with pstats or snakeviz"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profile = None
+
+    def toggle(self):
+        if self.profile is None:
+            logger.info("Profiling started")
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return
+        self.profile.disable()
+        path = os.path.join(self.directory,
+                            f'aiotunnel-{os.getpid()}-{time.strftime("%Y%m%d%H%M%S")}.prof')
+        self.profile.dump_stats(path)
+        self.profile = None
+        logger.info("Profile written to %s", path)
+
+
+def setup_tracing(loop):
+    """Start writing the traces to the trace file and install the profiler signal handler as
+    configured in CONFIG['tracing'], to be called from the loop serving the tunnels"""
+    global trace_listener
+    conf = CONFIG['tracing']
+    if conf['trace_file'] and enabled() and trace_listener is None:
+        fh = logging.FileHandler(conf['trace_file'])
+        fh.setFormatter(TraceFormatter())
+        qh = TraceHandler(queue.SimpleQueue())
+        trace_logger.setLevel(logging.INFO)
+        trace_logger.addHandler(qh)
+        trace_listener = LogListener(qh, fh)
+        trace_listener.start()
+        atexit.register(stop_tracing)
+    if conf['profile_dir']:
+        profiler = Profiler(conf['profile_dir'])
+        try:
+            loop.add_signal_handler(getattr(signal, conf['profile_signal']), profiler.toggle)
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError) as e:
+            logger.warning("Cannot install the profiler on %s: %s", conf['profile_signal'], e)
@@ -28,25 +28,100 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import ssl
 import asyncio
+import weakref
 import logging
+from functools import partial
 
 import aiohttp
 
-from .protocol import LocalTunnelProtocol
+from . import CONFIG, metrics, compression, tls, tracing, tune_event_loop
+from .mux import Multiplexer
+from .pool import TunnelPool
+from .balancer import Balancer
+from .protocol import LocalTunnelProtocol, MuxTunnelProtocol, Backoff
 
 
 logger = logging.getLogger(__name__)
 
 
-async def create_endpoint(url, client_addr, target_addr, ssl_context=None):
+def create_session(ssl_context=None):
+    """Create the HTTP client session shared by every connection of the tunnel process, backed
+    by a keep-alive connection pool, so that PUT/GET calls reuse the same TCP (and TLS)
+    connections instead of opening a new one for each chunk of data.
+
+    Args:
+    -----
+    :type ssl_context: ssl.SSLContext
+    :param ssl_context: The SSL context to use for HTTPS connections to the server, None for
+                        plain HTTP
+    """
+    conf = CONFIG['client']
+    connector = aiohttp.TCPConnector(
+        limit=conf['pool_limit'],
+        limit_per_host=conf['pool_limit_per_host'],
+        keepalive_timeout=conf['keepalive_timeout'],
+        ttl_dns_cache=conf['dns_cache_ttl'],
+        ssl=ssl_context
+    )
+    return aiohttp.ClientSession(connector=connector,
+                                 trace_configs=[metrics.client_trace_config()])
+
+
+def compression_requested():
+    """Tell if tunnels ask the server for compression, only possible with the transports
+    carrying every chunk as a message of its own"""
+    conf = CONFIG['client']
+    return conf['compression'] and conf['transport'] in compression.TRANSPORTS
+
+
+def protocol_factory(remote_host, url, session, on_conn_lost=None, **kwargs):
+    """Return a LocalTunnelProtocol factory, configured according to CONFIG['client'] unless
+    overridden by kwargs, url being the server of the tunnels unless a balancer places them"""
+    conf = CONFIG['client']
+    options = dict(
+        mode=conf['transport'],
+        max_batch_size=conf['max_batch_size'],
+        flush_delay=conf['flush_delay'],
+        compression=conf['compression'],
+        compression_level=conf['compression_level'],
+        compression_threshold=conf['compression_threshold'],
+        write_window=conf['write_window'],
+        resume_timeout=conf['resume_timeout'],
+        high_watermark=conf['high_watermark'],
+        low_watermark=conf['low_watermark']
+    )
+    options.update(kwargs)
+    return lambda: LocalTunnelProtocol(remote_host, url, session, on_conn_lost, **options)
+
+
+def pooled_protocol_factory(remote_host, url, session, pool, balancer=None):
+    """Return a LocalTunnelProtocol factory using the tunnels ready in pool, opening new ones
+    only when it's empty"""
+    factory = protocol_factory(remote_host, url, session, balancer=balancer)
+
+    def pooled_factory():
+        tunnel = pool.take()
+        if tunnel is None:
+            return factory()
+        cid, compressed, url = tunnel
+        return protocol_factory(remote_host, url, session, cid=cid, compression=compressed,
+                                balancer=balancer)()
+
+    return pooled_factory
+
+
+async def create_endpoint(balancer, session, client_addr, target_addr, multiplexer=None):
     """Create a server endpoint TCP.
 
     Args:
     -----
-    :type url: str
-    :param url: The URL of the server part to communicate with using HTTP calls
+    :type balancer: aiotunnel.balancer.Balancer
+    :param balancer: The servers to place the tunnels on, communicating with them using HTTP
+                     calls
+
+    :type session: aiohttp.ClientSession
+    :param session: The HTTP session shared by all the forwardings of the process
 
     :type client_addr: tuple
     :param client_addr: A tuple (host, port) to expose a port on an address
@@ -54,32 +129,57 @@ async def create_endpoint(url, client_addr, target_addr, ssl_context=None):
     :type target_addr: tuple
     :param target_addr: A tuple (host, port) to expose a address:port on the server side in order to
                         let clients connection to the tunnel.
+
+    :type multiplexer: aiotunnel.mux.Multiplexer
+    :param multiplexer: The WebSocket carrying all the connections with the mux transport
     """
     # Get a reference to the event loop as we plan to use
     # low-level APIs.
     host, port = client_addr
     target_host, target_port = target_addr
     remote_host = target_host + ':' + str(target_port)
-    scheme = 'HTTPS' if ssl_context else 'HTTP'
+    url = next(iter(balancer.servers))
+    scheme = url.split(':', 1)[0].upper()
     logger.info("Listening on port %s", port)
     logger.info("Opening %s connection to %s:%s", scheme, target_host, target_port)
     loop = asyncio.get_running_loop()
+    conf = CONFIG['client']
+    pool = task = None
+    if multiplexer:
+        factory = partial(MuxTunnelProtocol, remote_host, multiplexer)
+    elif conf['tunnel_pool_size']:
+        # Tunnels opened in advance, taken by the accepted connections
+        pool = TunnelPool(url, session, remote_host, conf['tunnel_pool_size'],
+                          conf['tunnel_pool_ttl'], compression_requested(), balancer)
+        task = loop.create_task(pool.run())
+        factory = pooled_protocol_factory(remote_host, url, session, pool, balancer)
+    else:
+        factory = protocol_factory(remote_host, url, session, balancer=balancer)
     # Start the server and serve forever
-    server = await loop.create_server(
-        lambda: LocalTunnelProtocol(remote_host, url, ssl_context),
-        host, port
-    )
+    server = await loop.create_server(factory, host, port)
     async with server:
-        await server.serve_forever()
+        try:
+            await server.serve_forever()
+        finally:
+            if task:
+                task.cancel()
+            if pool:
+                await pool.close()
 
 
-async def open_connection(url, client_addr, target_addr, ssl_context=None):
-    """Open a TCP connection
+async def open_connection(balancer, session, client_addr, target_addr):
+    """Open a reverse endpoint on the server side and a TCP connection to the target for
+    every connection it accepts, opening it again on another server if the one holding it
+    fails
 
     Args:
     -----
-    :type url: str
-    :param url: The URL of the server part to communicate with using HTTP calls
+    :type balancer: aiotunnel.balancer.Balancer
+    :param balancer: The servers to open the endpoint on, communicating with them using HTTP
+                     calls
+
+    :type session: aiohttp.ClientSession
+    :param session: The HTTP session shared by all the forwardings of the process
 
     :type client_addr: tuple
     :param client_addr: A tuple (host, port) to expose a port on an address
@@ -91,33 +191,187 @@ async def open_connection(url, client_addr, target_addr, ssl_context=None):
 
     remote = f'{client_addr[0]}:{client_addr[1]}'
     host, port = target_addr
-    scheme = 'HTTPS' if ssl_context else 'HTTP'
-    logger.info("Opening a TCP connection to %s:%s (target)", host, port)
-    logger.info("Opening %s connection to %s (source)", scheme, remote)
+    logger.info("Forwarding connections to %s:%s (target)", host, port)
+    # Protocols of the open target connections, to close on exit
+    protocols = weakref.WeakSet()
+    backoff = Backoff(float('inf'))
+    try:
+        while True:
+            endpoint = await open_endpoint(balancer, session, remote)
+            if endpoint is None:
+                return
+            if endpoint is False:
+                await backoff.wait()
+                continue
+            backoff.reset()
+            url, cid, compressed = endpoint
+            await accept_connections(balancer, session, url, cid, compressed, remote,
+                                     target_addr, protocols)
+    finally:
+        for protocol in list(protocols):
+            protocol.transport.close()
+
+
+async def open_endpoint(balancer, session, remote):
+    """Open the reverse endpoint remote on the best server available, return its
+    (url, cid, compressed), False if no server could open it and None if refused. A server
+    which can't bind the port, answering 409, is tried again later without being ejected"""
+    headers = None
+    if compression_requested():
+        headers = {compression.HEADER: compression.CODEC}
+    loop = asyncio.get_running_loop()
+    for server in await balancer.place():
+        scheme = server.url.split(':', 1)[0].upper()
+        logger.info("Opening %s endpoint on %s (source) with %s", scheme, remote, server.url)
+        start = loop.time()
+        try:
+            async with session.post(server.url, data=remote.encode(),
+                                    params={'mode': 'reverse'}, headers=headers,
+                                    timeout=balancer.timeout) as resp:
+                resp.raise_for_status()
+                cid = await resp.text()
+                compressed = resp.headers.get(compression.HEADER) == compression.CODEC
+        except aiohttp.ClientResponseError as e:
+            metrics.HTTP_ERRORS.inc()
+            if e.status == 409:
+                logger.error("Unable to bind the endpoint on %s with %s: %s",
+                             remote, server.url, str(e))
+            elif e.status < 500:
+                logger.critical("Unable to open the endpoint on %s: %s", remote, str(e))
+                return None
+            else:
+                logger.error("Unable to open the endpoint on %s: %s", remote, str(e))
+                balancer.failed(server.url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.HTTP_ERRORS.inc()
+            logger.error("Unable to open the endpoint on %s: %s", remote, str(e))
+            balancer.failed(server.url)
+        else:
+            balancer.placed(server.url, loop.time() - start)
+            logger.info("Obtained an endpoint id: %s", cid)
+            return server.url, cid, compressed
+    return False
+
+
+async def accept_connections(balancer, session, url, cid, compressed, remote, target_addr,
+                             protocols):
+    """Long poll the connections accepted by the endpoint cid, connecting each one to the
+    target, until the endpoint is closed or the server holding it gets ejected"""
+    host, port = target_addr
+    loop = asyncio.get_running_loop()
+    backoff = Backoff(float('inf'))
+    while True:
+        try:
+            async with session.get(f'{url}/{cid}/accept') as resp:
+                if resp.status in (404, 410):
+                    logger.info("Endpoint %s closed by the server", cid)
+                    return
+                if resp.status == 204:
+                    continue
+                stream_cid = await resp.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.debug("Cannot communicate with %s", url)
+            metrics.HTTP_ERRORS.inc()
+            balancer.failed(url)
+            if not balancer.available(url):
+                logger.warning("Moving the endpoint on %s away from %s", remote, url)
+                return
+            await backoff.wait()
+            continue
+        backoff.reset()
+        balancer.succeeded(url)
+        factory = protocol_factory(remote, url, session, cid=stream_cid,
+                                   compression=compressed, balancer=balancer)
+        loop.create_task(connect_target(url, session, stream_cid, factory,
+                                        host, port, protocols))
+
+
+async def connect_target(url, session, cid, factory, host, port, protocols):
+    """Open the target connection of a stream accepted by a reverse endpoint, closing the
+    stream on the server side if the target is unreachable"""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        _, protocol = await loop.create_connection(factory, host, port)
+    except OSError as e:
+        metrics.CONNECT_ERRORS.inc()
+        logger.error("Unable to connect to %s:%s: %s", host, port, str(e))
+        try:
+            async with session.delete(f'{url}/{cid}'):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.HTTP_ERRORS.inc()
+        return
+    metrics.CONNECT_LATENCY.observe(loop.time() - start)
+    protocols.add(protocol)
+
+
+def parse_forwardings(forwardings, reverse=False):
+    """Read the forwardings list of the client configuration, each one a dict with the
+    target_host and target_port to reach, the port and optionally the host to expose them on
+    and a reverse flag, defaulting to CONFIG['client'] host and reverse. Return a list of
+    (client_addr, target_addr, reverse) tuples"""
+    parsed = []
+    for forwarding in forwardings:
+        options = dict(host=CONFIG['client']['host'], reverse=reverse)
+        options.update(forwarding)
+        try:
+            client_addr = (options['host'], int(options['port']))
+            target_addr = (options['target_host'], int(options['target_port']))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Invalid forwarding {forwarding}')
+        parsed.append((client_addr, target_addr, bool(options['reverse'])))
+    return parsed
+
+
+async def run_tunnel(urls, forwardings, ssl_context=None):
+    """Run all the forwardings of the process, each (client_addr, target_addr, reverse) in the
+    requested direction, over a single HTTP session to the servers at urls, serving the
+    metrics on the side if a metrics port is configured"""
     loop = asyncio.get_running_loop()
-    on_con_lost = loop.create_future()
+    tune_event_loop(loop)
+    tracing.setup_tracing(loop)
+    conf = CONFIG['client']
+    runner = None
+    if conf['metrics_port']:
+        runner = await metrics.start_metrics_server(conf['metrics_host'], conf['metrics_port'])
     try:
-        transport, _ = await loop.create_connection(
-            lambda: LocalTunnelProtocol(remote, url, on_con_lost, ssl_context),
-            host, port
-        )
-        await on_con_lost
-    except Exception as e:
-        logger.critical("Unable to connect: %s", str(e))
+        async with create_session(ssl_context) as session:
+            balancer = Balancer(urls, session, conf['balancing'],
+                                conf['health_check_interval'], conf['failure_threshold'],
+                                conf['reset_timeout'], conf['connect_timeout'])
+            tasks = [loop.create_task(balancer.run())]
+            multiplexer = None
+            if conf['transport'] == 'mux':
+                # All the connections of every forwarding share a single WebSocket
+                multiplexer = Multiplexer(urls[0], session, conf['max_batch_size'],
+                                          conf['high_watermark'], conf['low_watermark'],
+                                          balancer)
+                tasks.append(loop.create_task(multiplexer.run()))
+            try:
+                await asyncio.gather(*(
+                    open_connection(balancer, session, client_addr, target_addr) if reverse
+                    else create_endpoint(balancer, session, client_addr, target_addr,
+                                         multiplexer)
+                    for client_addr, target_addr, reverse in forwardings
+                ))
+            finally:
+                for task in tasks:
+                    task.cancel()
     finally:
-        transport.close()
+        if runner:
+            await runner.cleanup()
 
 
 def start_tunnel(url, client_addr, target_addr,
                  reverse=False, cafile=None, certfile=None, keyfile=None):
-    ssl_context = None
-    if cafile:
-        ssl_context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH, cafile=cafile)
-        ssl_context.load_cert_chain(certfile, keyfile)
+    start_tunnels([url], [(client_addr, target_addr, reverse)],
+                  cafile=cafile, certfile=certfile, keyfile=keyfile)
+
+
+def start_tunnels(urls, forwardings, cafile=None, certfile=None, keyfile=None):
+    ssl_context = tls.create_client_context(cafile, certfile, keyfile) if cafile else None
     try:
-        if not reverse:
-            asyncio.run(create_endpoint(url, client_addr, target_addr, ssl_context))
-        else:
-            asyncio.run(open_connection(url, client_addr, target_addr, ssl_context))
+        asyncio.run(run_tunnel(urls, forwardings, ssl_context))
     except:
         pass
@@ -28,170 +28,1007 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import ssl
-import uuid
+import os
+import heapq
+import secrets
+import signal
 import logging
 import asyncio
+import tempfile
+import multiprocessing
 from functools import partial
-from collections import namedtuple
+from collections import OrderedDict
 
-from aiohttp import web
+import aiohttp
+from aiohttp import web, WSMsgType, WSCloseCode
 
-from . import CONFIG
-from .protocol import TunnelProtocol
+from . import CONFIG, ACCESS_LOGGER, stop_logging, tune_event_loop
+from . import metrics, compression, tls, tracing
+from .mux import FrameSender, unpack_frames, OPEN, DATA, CLOSE, WINDOW, WINDOW_SIZE, CREDIT
+from .buffers import BUFFERS
+from .scheduler import Scheduler
+from .protocol import TunnelProtocol, FlowControl, ChunkQueue, Flag
+from .protocol import SEQ_HEADER, ACK_HEADER, OFFSET_HEADER
 
 
 logger = logging.getLogger(__name__)
 
-# Connection simple abstraction
-Connection = namedtuple('Connection', ('transport', 'channel'))
+# How many closed cids to remember in order to answer 410 instead of 404
+CLOSED_CIDS_SIZE = 4096
+
+# Most tunnels opened by a single POST, clients keeping a pool of them ready
+# ask for several at once
+MAX_BULK_TUNNELS = 64
+
+# How far ahead of the expected one a sequenced chunk can be, bounding the
+# reorder buffer of every tunnel
+REORDER_WINDOW = 64
+
+# Headers not to copy when forwarding requests between workers
+HOP_BY_HOP_HEADERS = {'host', 'connection', 'keep-alive', 'content-length', 'transfer-encoding',
+                      'upgrade'}
+
+# Address of the client of a request forwarded by another worker
+CLIENT_HEADER = 'X-Aiotunnel-Client'
+
+
+class Lease:
+
+    """Expiry bookkeeping of a tunnel, used as a context manager by the requests attached to
+    it for their whole duration: a tunnel is idle only when no request is attached"""
+
+    __slots__ = ('created', 'last_seen', 'attached')
+
+    def __init__(self, now):
+        self.created = now
+        self.last_seen = now
+        self.attached = 0
+
+    def touch(self):
+        self.last_seen = asyncio.get_running_loop().time()
+
+    def __enter__(self):
+        self.attached += 1
+        self.touch()
+        return self
+
+    def __exit__(self, *exc):
+        self.attached -= 1
+
+
+class Session(Lease):
+
+    """A tunnel, its target transport and channel, server being the endpoint listening for the
+    target connections in reverse mode, along with its own expiry bookkeeping"""
+
+    __slots__ = ('transport', 'channel', 'server')
+
+    def __init__(self, transport, channel, server, now):
+        super().__init__(now)
+        self.transport = transport
+        self.channel = channel
+        self.server = server
+        self.touch()
 
 
 class Channel:
 
     """Duplex communication channel, can be seen as a basic pipe, constituted by two asynchronous
-    queue"""
+    queue, each one bounded in bytes by its flow control: requests pushers wait for the target
+    to consume them, response producers (the target transports) are paused until the client
+    reads them"""
+
+    # Queued on the response side to wake up readers once the target closed
+    EOF = None
+
+    __slots__ = ('req', 'res', 'req_flow', 'res_flow', 'closed', 'compressor', 'next_seq',
+                 'reorder', 'reorder_lock', 'sent', 'unacked', 'acking', 'poller', 'target', 'cid',
+                 'req_tracer', 'res_tracer', 'req_traces', 'res_traces')
+
+    def __init__(self, high_watermark=None, low_watermark=None):
+        high_watermark = high_watermark or CONFIG['server']['high_watermark']
+        low_watermark = low_watermark or CONFIG['server']['low_watermark']
+        self.req = ChunkQueue()
+        self.res = ChunkQueue()
+        self.req_flow = FlowControl(high_watermark, low_watermark)
+        self.res_flow = FlowControl(high_watermark, low_watermark)
+        self.closed = False
+        # Compressor of the responses, set if the client negotiated compression
+        self.compressor = None
+        # Sequenced requests arrived ahead of the expected one, created along
+        # with the first one
+        self.next_seq = 0
+        self.reorder = None
+        self.reorder_lock = None
+        # Responses handed out as (offset, data) and not acknowledged yet, only
+        # kept for clients sending acks, rarely more than two of them so a list
+        # is lighter than a deque
+        self.sent = 0
+        self.unacked = ()
+        self.acking = False
+        # Resolved to wake up the pending long poll once superseded
+        self.poller = None
+        # Protocol of the target connection, woken up as requests come in
+        self.target = None
+        # Follow the sampled chunks through the queues, None unless tracing is
+        # enabled, and the traces of the last chunks pulled
+        self.cid = None
+        self.req_tracer = tracing.queue_tracer()
+        self.res_tracer = tracing.queue_tracer()
+        self.req_traces = ()
+        self.res_traces = ()
+
+    def close(self):
+        self.closed = True
+        self.res.put_nowait(self.EOF)
 
-    def __init__(self):
-        self.req = asyncio.Queue()
-        self.res = asyncio.Queue()
+    def release(self):
+        """Close the target transports attached to the channel and drop all the queued data,
+        waking up any reader"""
+        for transport in list(self.res_flow.transports):
+            transport.close()
+        for queue, flow in ((self.req, self.req_flow), (self.res, self.res_flow)):
+            while not queue.empty():
+                BUFFERS.release(queue.get_nowait())
+                queue.task_done()
+            flow.remove(flow.size)
+        self.close()
 
-    async def push_request(self, request):
-        return await self.req.put(request)
+    async def push_request(self, request, trace=None):
+        await self.req_flow.writable.wait()
+        self.push_request_nowait(request, trace)
+
+    def push_request_nowait(self, request, trace=None):
+        self.req.put_nowait(request)
+        self.req_flow.add(len(request))
+        if self.req_tracer:
+            self.req_tracer.put(len(request), trace)
+        if self.target is not None:
+            self.target.wakeup()
+        metrics.BYTES_IN.inc(len(request))
+        metrics.CHUNKS_IN.inc()
+
+    async def push_sequenced(self, seq, request, trace=None):
+        """Push the requests in sequence order, holding those arrived early until the missing
+        ones come in and dropping duplicates. Return False if seq is too far ahead to be held"""
+        if self.reorder is None:
+            self.reorder = {}
+            self.reorder_lock = asyncio.Lock()
+        if seq < self.next_seq or seq in self.reorder:
+            return True
+        if seq >= self.next_seq + REORDER_WINDOW:
+            return False
+        self.reorder[seq] = request, trace
+        async with self.reorder_lock:
+            while self.next_seq in self.reorder:
+                request, trace = self.reorder.pop(self.next_seq)
+                self.next_seq += 1
+                await self.push_request(request, trace)
+        return True
+
+    def push_response_nowait(self, response):
+        self.res.put_nowait(response)
+        self.res_flow.add(len(response))
+        if self.res_tracer:
+            self.res_tracer.put(len(response),
+                                tracing.sample('server', 'down', self.cid, len(response)))
 
     async def push_response(self, response):
-        return await self.res.put(response)
+        self.push_response_nowait(response)
 
     async def pull_request(self):
         data = await self.req.get()
         self.req.task_done()
+        self.req_flow.remove(len(data))
+        if self.req_tracer:
+            self.req_traces = self.req_tracer.get(len(data), 'queue')
         return data
 
     async def pull_response(self):
         data = await self.res.get()
         self.res.task_done()
+        if data is not self.EOF:
+            self.res_flow.remove(len(data))
+        return data
+
+    async def pull_responses(self, max_size, timeout=None, poll=False):
+        """Wait at most timeout seconds for a response and join it with all the other queued
+        ones, up to max_size bytes. Return None if nothing arrived in time or the channel is
+        closed. A long poll supersedes the pending one, which returns None right away as its
+        client gave up on it after losing the connection"""
+        loop = asyncio.get_running_loop()
+        getter = loop.create_task(self.pull_response())
+        waiters = {getter}
+        if poll:
+            if self.poller is not None and not self.poller.done():
+                self.poller.set_result(None)
+            self.poller = loop.create_future()
+            waiters.add(self.poller)
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Leaves the response in the queue unless already pulled
+            getter.cancel()
+        if not getter.done() or getter.cancelled():
+            return None
+        data = getter.result()
+        if data is self.EOF:
+            return None
+        batch, size = [data], len(data)
+        while size < max_size and not self.res.empty():
+            data = self.res.get_nowait()
+            self.res.task_done()
+            if data is self.EOF:
+                break
+            self.res_flow.remove(len(data))
+            batch.append(data)
+            size += len(data)
+        metrics.BYTES_OUT.inc(size)
+        metrics.CHUNKS_OUT.inc()
+        if self.res_tracer:
+            self.res_traces = self.res_tracer.get(size, 'queue')
+        # Responses are chunks read by the target protocols, copy them out
+        # once and give their buffers back
+        data = b''.join(batch)
+        for chunk in batch:
+            BUFFERS.release(chunk)
+        if self.acking:
+            self.unacked.append((self.sent, data))
+        self.sent += len(data)
         return data
 
+    def acknowledge(self, offset):
+        """Drop the responses received by the client up to offset, return the offset and data
+        of those lost on the way to be sent again, None if there's none"""
+        if not self.acking:
+            self.acking = True
+            self.unacked = []
+        while self.unacked and self.unacked[0][0] + len(self.unacked[0][1]) <= offset:
+            del self.unacked[0]
+        if not self.unacked:
+            return None
+        return self.unacked[0][0], b''.join(data for _, data in self.unacked)
+
+    def encode_response(self, response):
+        if self.compressor:
+            return self.compressor.compress(response)
+        return response
+
+    def decode_request(self, request):
+        """Raise ValueError if a compressed request is corrupted or expands beyond what the
+        channel would ever buffer"""
+        if self.compressor:
+            max_size = max(CONFIG['server']['max_poll_size'], self.req_flow.high_watermark)
+            return compression.decompress(request, max_size)
+        return request
+
+
+class MuxChannel(Channel):
+
+    """Channel of a stream of a multiplexed WebSocket, granting the client credit for more
+    requests as the target consumes them, credit sets how many response bytes can still be sent
+    to the client, closing is set once the client closed the stream"""
+
+    __slots__ = ('stream_id', 'sender', 'credit', 'window_open', 'closing')
+
+    def __init__(self, stream_id, sender):
+        super().__init__()
+        self.stream_id = stream_id
+        self.sender = sender
+        self.credit = WINDOW_SIZE
+        self.window_open = Flag(True)
+        self.closing = Flag()
+
+    async def pull_request(self):
+        data = await super().pull_request()
+        self.sender.send(self.stream_id, WINDOW, CREDIT.pack(len(data)))
+        return data
+
+    def grant(self, size):
+        self.credit += size
+        if self.credit > 0:
+            self.window_open.set()
+
+    def spend(self, size):
+        self.credit -= size
+        if self.credit <= 0:
+            self.window_open.clear()
+
 
 class Handler:
 
-    def __init__(self, app, reverse=False):
+    """Serve the tunnels, in a multi-process setup worker_sockets is the list of Unix sockets
+    each worker listens to, indexed by worker id: cids carry the id of the worker owning them
+    and requests landing on another worker are forwarded to the owner through its socket"""
+
+    def __init__(self, app, reverse=False, worker_id=0, worker_sockets=None):
         self.reverse = reverse
-        self.conn = None
         self.tunnels = {}
+        # Reverse endpoint cid -> queue of the cids of the connections it
+        # accepted, waiting for the client to open the matching targets
+        self.accepts = {}
+        self.closed_cids = OrderedDict()
+        self.poll_timeout = CONFIG['server']['poll_timeout']
+        self.max_poll_size = CONFIG['server']['max_poll_size']
+        # Heap of (deadline, cid), entries are checked against the lease of the
+        # tunnel when they expire and pushed back if it has been used since
+        self.expiries = []
+        self.idle_timeout = CONFIG['server']['idle_timeout']
+        self.max_lifetime = CONFIG['server']['max_lifetime']
+        self.reaper = None
+        # Rate limits and fair sharing of each direction, None if unlimited
+        self.uplink = Scheduler.from_config('up', CONFIG['server'])
+        self.downlink = Scheduler.from_config('down', CONFIG['server'])
+        if self.downlink and self.downlink.max_chunk_size:
+            self.max_poll_size = min(self.max_poll_size, self.downlink.max_chunk_size)
+        self.worker_id = worker_id
+        self.worker_sockets = worker_sockets or []
+        self.worker_sessions = {}
+        self.internal_runner = None
         self.app = app
-        self.app.add_routes([
+        self.add_routes(self.app)
+        if self.worker_sockets:
+            self.app.middlewares.append(self.route_to_owner)
+            self.app.on_startup.append(self.start_internal_site)
+        if self.idle_timeout or self.max_lifetime:
+            self.app.on_startup.append(self.start_reaper)
+        self.logger = logging.getLogger('aiotunnel.tunneld.Handler')
+        metrics.QUEUE_DEPTH.labels('request').set_function(
+            lambda: sum(conn.channel.req.qsize() for conn in self.tunnels.values())
+        )
+        metrics.QUEUE_DEPTH.labels('response').set_function(
+            lambda: sum(conn.channel.res.qsize() for conn in self.tunnels.values())
+        )
+
+    def add_routes(self, app):
+        if CONFIG['server']['metrics']:
+            app.router.add_get('/aiotunnel/metrics', metrics.metrics_handler)
+        app.add_routes([
             web.post('/aiotunnel', self.post_aiotunnel),
+            web.get('/aiotunnel/health', self.health_aiotunnel),
+            web.get('/aiotunnel/mux', self.mux_aiotunnel),
             web.put('/aiotunnel/{cid}', self.put_aiotunnel),
             web.get('/aiotunnel/{cid}', self.get_aiotunnel),
+            web.get('/aiotunnel/{cid}/ws', self.ws_aiotunnel),
+            web.get('/aiotunnel/{cid}/accept', self.accept_aiotunnel),
             web.delete('/aiotunnel/{cid}', self.delete_aiotunnel)
         ])
-        self.logger = logging.getLogger('aiotunnel.tunneld.Handler')
+
+    def new_cid(self):
+        # 128 random bits as 22 URL safe characters, cheaper to keep around
+        # and to look up than an UUID string
+        cid = secrets.token_urlsafe(16)
+        if self.worker_sockets:
+            cid = f'{self.worker_id:x}-{cid}'
+        return cid
+
+    def owner_of(self, cid):
+        """Return the id of the worker owning cid, None if it can't tell"""
+        try:
+            owner = int(cid.split('-', 1)[0], 16)
+        except ValueError:
+            return None
+        return owner if owner < len(self.worker_sockets) else None
+
+    async def start_internal_site(self, app):
+        # Requests forwarded by the other workers come through a Unix socket,
+        # served by an app with the same routes
+        path = self.worker_sockets[self.worker_id]
+        if os.path.exists(path):
+            os.unlink(path)
+        internal_app = web.Application(middlewares=[metrics.server_middleware])
+        self.add_routes(internal_app)
+        self.internal_runner = web.AppRunner(internal_app, access_log=None)
+        await self.internal_runner.setup()
+        await web.UnixSite(self.internal_runner, path).start()
+
+    async def stop_internal_site(self):
+        for session in self.worker_sessions.values():
+            await session.close()
+        if self.internal_runner:
+            await self.internal_runner.cleanup()
+
+    def worker_session(self, owner):
+        if owner not in self.worker_sessions:
+            connector = aiohttp.UnixConnector(path=self.worker_sockets[owner])
+            self.worker_sessions[owner] = aiohttp.ClientSession(connector=connector)
+        return self.worker_sessions[owner]
+
+    @web.middleware
+    async def route_to_owner(self, request, handler):
+        cid = request.match_info.get('cid')
+        owner = self.owner_of(cid) if cid else None
+        if owner is None or owner == self.worker_id:
+            return await handler(request)
+        session = self.worker_session(owner)
+        url = f'http://worker-{owner}{request.path_qs}'
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await self.forward_ws(request, session, url)
+        return await self.forward(request, session, url)
+
+    async def forward(self, request, session, url):
+        headers = {k: v for k, v in request.headers.items()
+                   if k.lower() not in HOP_BY_HOP_HEADERS}
+        headers[CLIENT_HEADER] = self.client_of(request)
+        data = request.content.iter_any() if request.body_exists else None
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with session.request(request.method, url, headers=headers,
+                                   data=data, timeout=timeout) as upstream:
+            response = web.StreamResponse(status=upstream.status)
+            for key, value in upstream.headers.items():
+                if key.lower() not in HOP_BY_HOP_HEADERS:
+                    response.headers[key] = value
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+    async def forward_ws(self, request, session, url):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async def pump(source, destination):
+            async for msg in source:
+                if msg.type == WSMsgType.BINARY:
+                    await destination.send_bytes(msg.data)
+
+        try:
+            headers = {CLIENT_HEADER: self.client_of(request)}
+            async with session.ws_connect(url, headers=headers) as upstream:
+                loop = asyncio.get_running_loop()
+                tasks = [loop.create_task(pump(ws, upstream)),
+                         loop.create_task(pump(upstream, ws))]
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    task.cancel()
+        except aiohttp.ClientError as e:
+            self.logger.debug("Cannot forward WebSocket to %s: %s", url, e)
+        await ws.close()
+        return ws
 
     def close_all_tunnels(self):
-        if self.conn:
-            self.conn.close()
         for _, conn in self.tunnels.items():
             if conn.transport is not None:
                 conn.transport.close()
-        pending = asyncio.all_tasks()
+            if conn.server is not None:
+                conn.server.close()
+        # Sparing the caller, the shutdown still having to clean up
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
         for task in pending:
             if not task.cancelled():
                 task.cancel()
 
-    async def push_request(self, cid, request):
+    def get_tunnel(self, cid):
+        """Return the Session of an open cid, raise 410 Gone for recently closed ones and
+        404 Not Found for those never seen, so clients stop polling them"""
+        if cid in self.tunnels:
+            conn = self.tunnels[cid]
+            conn.touch()
+            return conn
+        if cid in self.closed_cids:
+            raise web.HTTPGone()
+        raise web.HTTPNotFound()
+
+    def add_tunnel(self, cid, transport, channel, server=None):
+        now = asyncio.get_running_loop().time()
+        self.tunnels[cid] = Session(transport, channel, server, now)
+        channel.cid = cid
+        if self.reaper:
+            heapq.heappush(self.expiries, (self.deadline_of(self.tunnels[cid], now), cid))
+
+    def close_tunnel(self, cid):
+        conn = self.tunnels.pop(cid)
+        if conn.transport is not None:
+            conn.transport.close()
+        if conn.server is not None:
+            conn.server.close()
+        conn.channel.release()
+        self.forget_flows(conn.channel)
+        self.accepts.pop(cid, None)
+        self.closed_cids[cid] = True
+        if len(self.closed_cids) > CLOSED_CIDS_SIZE:
+            self.closed_cids.popitem(last=False)
+
+    def client_of(self, request):
+        """Address of the client, requests forwarded by another worker come through a Unix
+        socket carrying it in a header"""
+        if self.worker_sockets and not request.remote:
+            return request.headers.get(CLIENT_HEADER, '')
+        return request.remote
+
+    async def throttle(self, scheduler, channel, request, size):
+        """Wait for the scheduler to let size bytes of the tunnel of channel through"""
+        if scheduler is not None:
+            await scheduler.transmit(channel, self.client_of(request), size)
+
+    def forget_flows(self, channel):
+        for scheduler in (self.uplink, self.downlink):
+            if scheduler is not None:
+                scheduler.forget(channel)
+
+    def deadline_of(self, lease, now):
+        """Return when a tunnel expires, the earliest of its idle and absolute deadlines. A
+        tunnel with attached requests is not idle, its idle deadline moves along"""
+        deadlines = []
+        if self.idle_timeout:
+            last_seen = now if lease.attached else lease.last_seen
+            deadlines.append(last_seen + self.idle_timeout)
+        if self.max_lifetime:
+            deadlines.append(lease.created + self.max_lifetime)
+        return min(deadlines)
+
+    async def start_reaper(self, app):
+        self.reaper = asyncio.get_running_loop().create_task(self.reap_tunnels())
+
+    async def reap_tunnels(self):
+        """Close the expired tunnels, sleeping until the next deadline. New tunnels never
+        expire before the ones already scheduled, so the heap head is always the next one"""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self.expiries and self.expiries[0][0] <= now:
+                _, cid = heapq.heappop(self.expiries)
+                conn = self.tunnels.get(cid)
+                if conn is None:
+                    continue
+                deadline = self.deadline_of(conn, now)
+                if deadline > now:
+                    heapq.heappush(self.expiries, (deadline, cid))
+                    continue
+                expired = self.max_lifetime and now >= conn.created + self.max_lifetime
+                reason = 'lifetime' if expired else 'idle'
+                self.logger.info("Closing %s tunnel %s", reason, cid)
+                metrics.TUNNELS_REAPED.labels(reason).inc()
+                self.close_tunnel(cid)
+            if self.expiries:
+                await asyncio.sleep(self.expiries[0][0] - now)
+            else:
+                await asyncio.sleep(min(t for t in (self.idle_timeout, self.max_lifetime) if t))
+
+    async def push_request(self, cid, request, trace=None):
         if cid not in self.tunnels:
             return
-        return await self.tunnels[cid].channel.push_request(request)
+        return await self.tunnels[cid].channel.push_request(request, trace)
 
     async def pull_response(self, cid):
         return await self.tunnels[cid].channel.pull_response()
 
     async def open_connection(self, host, port, channel):
         loop = asyncio.get_running_loop()
-        transport, protocol = await loop.create_connection(
-            lambda: TunnelProtocol(channel),
-            host, port
-        )
-        self.conn = protocol
+        start = loop.time()
+        try:
+            transport, protocol = await loop.create_connection(
+                lambda: TunnelProtocol(channel, close_channel=True),
+                host, port
+            )
+        except OSError:
+            metrics.CONNECT_ERRORS.inc()
+            raise
+        metrics.CONNECT_LATENCY.observe(loop.time() - start)
         return transport
 
-    async def create_endpoint(self, host, port, channel):
+    def new_channel(self, compressed=False):
+        channel = Channel()
+        if compressed:
+            conf = CONFIG['server']
+            channel.compressor = compression.Compressor(conf['compression_level'],
+                                                        conf['compression_threshold'])
+        return channel
+
+    async def create_endpoint(self, cid, host, port, compressed=False):
         # Get a reference to the event loop as we plan to use
         # low-level APIs.
         loop = asyncio.get_running_loop()
-        server = await loop.create_server(
-            lambda: TunnelProtocol(channel), host, port, reuse_port=True
-        )
-        self.conn = server
-        async with server:
-            await server.serve_forever()
+        self.accepts[cid] = asyncio.Queue()
+        try:
+            return await loop.create_server(
+                partial(self.accept_connection, cid, compressed), host, port, reuse_port=True
+            )
+        except OSError:
+            del self.accepts[cid]
+            raise
+
+    def accept_connection(self, cid, compressed):
+        """Give every connection accepted by the reverse endpoint cid a tunnel of its own,
+        queued for the client to open the matching target connection"""
+        channel = self.new_channel(compressed)
+        stream_cid = self.new_cid()
+        self.add_tunnel(stream_cid, None, channel)
+        self.accepts[cid].put_nowait(stream_cid)
+        return TunnelProtocol(channel, close_channel=True)
+
+    async def open_tunnel(self, host, port, compressed):
+        channel = self.new_channel(compressed)
+        transport = await self.open_connection(host, port, channel)
+        cid = self.new_cid()
+        self.add_tunnel(cid, transport, channel)
+        return cid
+
+    async def health_aiotunnel(self, request):
+        """Health check of the balancing clients, answering with the number of open tunnels"""
+        return web.Response(text=str(len(self.tunnels)))
 
     async def post_aiotunnel(self, request):
-        cid = uuid.uuid4()
+        """Open a tunnel, or in forward mode up to ?count= of them at once, answering with
+        their cids one per line. The ?mode= of the tunnel defaults to the one of the server,
+        reverse endpoints being only allowed to a server running in reverse mode"""
         service = await request.text()
-        channel = Channel()
+        headers = {}
+        compressed = (CONFIG['server']['compression']
+                      and request.headers.get(compression.HEADER) == compression.CODEC)
+        if compressed:
+            headers[compression.HEADER] = compression.CODEC
         host, port = service.split(':')
-        if self.reverse:
+        mode = request.query.get('mode')
+        reverse = self.reverse if mode is None else mode == 'reverse'
+        if reverse and not self.reverse:
+            raise web.HTTPForbidden()
+        if reverse:
+            # The endpoint channel carries no data, every accepted connection
+            # gets its own
             self.logger.info("Opening local port %s", port)
-            loop = asyncio.get_running_loop()
-            loop.create_task(self.create_endpoint(host, int(port), channel))
-            self.tunnels[str(cid)] = Connection(None, channel)
-        else:
-            self.logger.info("Opening connection with %s:%s", host, port)
-            transport = await self.open_connection(host, int(port), channel)
-            self.tunnels[str(cid)] = Connection(transport, channel)
-        return web.Response(text=str(cid))
+            cid = self.new_cid()
+            try:
+                server = await self.create_endpoint(cid, host, int(port), compressed)
+            except OSError as e:
+                # Most likely the port is taken, no fault of the server
+                self.logger.error("Unable to open local port %s: %s", port, e)
+                raise web.HTTPConflict()
+            self.add_tunnel(cid, None, self.new_channel(compressed), server)
+            return web.Response(text=cid, headers=headers)
+        try:
+            count = min(max(int(request.query.get('count', 1)), 1), MAX_BULK_TUNNELS)
+        except ValueError:
+            raise web.HTTPBadRequest()
+        self.logger.info("Opening %s connection(s) with %s:%s", count, host, port)
+        results = await asyncio.gather(
+            *(self.open_tunnel(host, int(port), compressed) for _ in range(count)),
+            return_exceptions=True
+        )
+        cids = [result for result in results if isinstance(result, str)]
+        if not cids:
+            if isinstance(results[0], OSError):
+                self.logger.error("Unable to connect to %s:%s: %s", host, port, results[0])
+                raise web.HTTPBadGateway()
+            raise results[0]
+        return web.Response(text='\n'.join(cids), headers=headers)
 
     async def put_aiotunnel(self, request):
         cid = request.match_info['cid']
-        if cid not in self.tunnels:
+        conn = self.get_tunnel(cid)
+        channel = conn.channel
+        seq = request.headers.get(SEQ_HEADER)
+        if seq is not None or channel.compressor:
+            # Sequenced and compressed chunks are sent one per request
+            try:
+                data = channel.decode_request(await request.read())
+            except ValueError as e:
+                self.logger.warning("Refusing a chunk of %s: %s", cid, e)
+                raise web.HTTPBadRequest()
+            trace = tracing.carry_on(request.headers, 'server', 'up', cid, len(data))
+            await self.throttle(self.uplink, channel, request, len(data))
+            if trace:
+                trace.mark('throttle')
+            if seq is None:
+                await self.push_request(cid, data, trace)
+                return web.Response()
+            try:
+                seq = int(seq)
+            except ValueError:
+                raise web.HTTPBadRequest()
+            if not await channel.push_sequenced(seq, data, trace):
+                raise web.HTTPServiceUnavailable()
             return web.Response()
-        data = await request.read()
-        await self.push_request(cid, data)
+        # Read the body as it arrives, a streaming client keeps a single
+        # chunked PUT open for the whole life of the connection
+        with conn:
+            try:
+                async for data in request.content.iter_any():
+                    trace = channel.req_tracer and tracing.sample('server', 'up', cid, len(data))
+                    await self.throttle(self.uplink, channel, request, len(data))
+                    if trace:
+                        trace.mark('throttle')
+                    await self.push_request(cid, data, trace)
+            except ConnectionResetError:
+                self.logger.debug("Streaming upload of %s interrupted", cid)
         return web.Response()
 
     async def get_aiotunnel(self, request):
         cid = request.match_info['cid']
-        if cid not in self.tunnels:
-            return web.Response()
-        result = await self.pull_response(cid)
-        return web.Response(body=result)
+        conn = self.get_tunnel(cid)
+        channel = conn.channel
+        if request.query.get('stream'):
+            with conn:
+                return await self.stream_responses(request, cid, channel)
+        ack = request.headers.get(ACK_HEADER)
+        if ack is not None:
+            try:
+                lost = channel.acknowledge(int(ack))
+            except ValueError:
+                raise web.HTTPBadRequest()
+            if lost is not None:
+                # The previous response never made it to the client
+                offset, result = lost
+                await self.throttle(self.downlink, channel, request, len(result))
+                return web.Response(body=channel.encode_response(result),
+                                    headers={OFFSET_HEADER: str(offset)})
+        result = None
+        if not channel.closed or not channel.res.empty():
+            with conn:
+                result = await channel.pull_responses(self.max_poll_size, self.poll_timeout,
+                                                      poll=True)
+        if result is not None:
+            offset = channel.sent - len(result)
+            traces, channel.res_traces = channel.res_traces, ()
+            await self.throttle(self.downlink, channel, request, len(result))
+            headers = {OFFSET_HEADER: str(offset)}
+            if traces:
+                # The client carries on with the first one
+                headers[tracing.TRACE_HEADER] = traces[0].trace_id
+                tracing.finish_all(traces, 'throttle')
+            return web.Response(body=channel.encode_response(result), headers=headers)
+        if channel.closed and not channel.unacked:
+            # Target gone and everything already delivered
+            if cid in self.tunnels:
+                self.close_tunnel(cid)
+            raise web.HTTPGone()
+        raise web.HTTPNoContent()
+
+    async def stream_responses(self, request, cid, channel):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        while cid in self.tunnels:
+            data = await channel.pull_responses(self.max_poll_size, self.poll_timeout)
+            if data is not None:
+                traces, channel.res_traces = channel.res_traces, ()
+                await self.throttle(self.downlink, channel, request, len(data))
+                await response.write(data)
+                tracing.finish_all(traces, 'send')
+            elif channel.closed:
+                break
+            # Nothing to send, just check that the client is still there
+            elif request.transport is None or request.transport.is_closing():
+                break
+        return response
+
+    async def accept_aiotunnel(self, request):
+        """Long poll the connections accepted by a reverse endpoint, answering with the cid of
+        the next one"""
+        cid = request.match_info['cid']
+        conn = self.get_tunnel(cid)
+        if cid not in self.accepts:
+            raise web.HTTPNotFound()
+        with conn:
+            try:
+                stream_cid = await asyncio.wait_for(self.accepts[cid].get(), self.poll_timeout)
+            except asyncio.TimeoutError:
+                raise web.HTTPNoContent()
+        return web.Response(text=stream_cid)
+
+    async def ws_aiotunnel(self, request):
+        cid = request.match_info['cid']
+        conn = self.get_tunnel(cid)
+        channel = conn.channel
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        loop = asyncio.get_running_loop()
+        sender = loop.create_task(self.ws_send_responses(request, ws, channel))
+        with conn:
+            try:
+                async for msg in ws:
+                    if msg.type == WSMsgType.BINARY:
+                        try:
+                            data = channel.decode_request(msg.data)
+                        except ValueError as e:
+                            self.logger.warning("Refusing a chunk of %s: %s", cid, e)
+                            await ws.close(code=WSCloseCode.MESSAGE_TOO_BIG)
+                            break
+                        trace = channel.req_tracer and tracing.sample('server', 'up', cid,
+                                                                      len(data))
+                        await self.throttle(self.uplink, channel, request, len(data))
+                        if trace:
+                            trace.mark('throttle')
+                        await channel.push_request(data, trace)
+                    elif msg.type == WSMsgType.ERROR:
+                        self.logger.debug("WebSocket of %s closed with %s", cid, ws.exception())
+            finally:
+                sender.cancel()
+        return ws
+
+    async def ws_send_responses(self, request, ws, channel):
+        while not ws.closed:
+            data = await channel.pull_responses(self.max_poll_size)
+            if data is None:
+                await ws.close()
+                break
+            traces, channel.res_traces = channel.res_traces, ()
+            await self.throttle(self.downlink, channel, request, len(data))
+            await ws.send_bytes(channel.encode_response(data))
+            tracing.finish_all(traces, 'send')
+
+    async def mux_aiotunnel(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        loop = asyncio.get_running_loop()
+        sender = FrameSender(self.max_poll_size, CONFIG['server']['high_watermark'],
+                             CONFIG['server']['low_watermark'])
+        sender_task = loop.create_task(sender.run(ws))
+        # stream id -> (channel, task serving the stream)
+        streams = {}
+        # Streams closed by the client, still delivering to their targets
+        draining = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.BINARY:
+                    continue
+                for stream_id, flags, payload in unpack_frames(msg.data):
+                    if flags & OPEN:
+                        channel = MuxChannel(stream_id, sender)
+                        task = loop.create_task(
+                            self.mux_stream(request, stream_id, payload.decode(), channel,
+                                            sender)
+                        )
+                        streams[stream_id] = (channel, task)
+                    if stream_id not in streams:
+                        continue
+                    channel = streams[stream_id][0]
+                    # Never wait here, it would hold back every stream of the
+                    # WebSocket: the client stops sending once out of credit
+                    if flags & DATA:
+                        # Allowing for the read overrunning the credit
+                        if channel.req_flow.size >= 2 * WINDOW_SIZE:
+                            self.logger.warning("Stream %s ignores its window, closing", stream_id)
+                            sender.send(stream_id, CLOSE)
+                            streams.pop(stream_id)[1].cancel()
+                            continue
+                        channel.push_request_nowait(payload)
+                    if flags & WINDOW:
+                        channel.grant(CREDIT.unpack(payload)[0])
+                    if flags & CLOSE:
+                        task = streams.pop(stream_id)[1]
+                        draining.add(task)
+                        task.add_done_callback(draining.discard)
+                        channel.closing.set()
+        finally:
+            sender_task.cancel()
+            for _, task in streams.values():
+                task.cancel()
+        return ws
+
+    async def mux_stream(self, request, stream_id, service, channel, sender):
+        host, port = service.split(':')
+        self.logger.info("Opening multiplexed stream %s with %s:%s", stream_id, host, port)
+        try:
+            transport = await self.open_connection(host, int(port), channel)
+        except OSError as e:
+            self.logger.debug("Cannot connect to %s: %s", service, e)
+            sender.send(stream_id, CLOSE)
+            return
+        loop = asyncio.get_running_loop()
+        responder = loop.create_task(self.mux_send_responses(request, stream_id, channel, sender))
+        closing = loop.create_task(channel.closing.wait())
+        drained = None
+        try:
+            await asyncio.wait((responder, closing), return_when=asyncio.FIRST_COMPLETED)
+            if not closing.done():
+                # Target gone
+                sender.send(stream_id, CLOSE)
+                return
+            # Let the target consume what's been uploaded before closing it
+            drained = loop.create_task(channel.req.join())
+            await asyncio.wait((drained, responder), timeout=self.poll_timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not drained.done():
+                self.logger.debug("Closing stream %s with requests still queued", stream_id)
+        finally:
+            for task in (responder, closing, drained):
+                if task is not None:
+                    task.cancel()
+            transport.close()
+            self.forget_flows(channel)
+
+    async def mux_send_responses(self, request, stream_id, channel, sender):
+        while True:
+            # Leave data in the channel, pausing the target, while the
+            # WebSocket is congested or the client is out of credit
+            await sender.flow.writable.wait()
+            await channel.window_open.wait()
+            data = await channel.pull_responses(self.max_poll_size)
+            if data is None:
+                break
+            traces, channel.res_traces = channel.res_traces, ()
+            await self.throttle(self.downlink, channel, request, len(data))
+            sender.send(stream_id, DATA, data)
+            channel.spend(len(data))
+            tracing.finish_all(traces, 'send')
 
     async def delete_aiotunnel(self, request):
         cid = request.match_info['cid']
-        if cid not in self.tunnels:
-            return web.Response()
-        self.tunnels[cid].transport.close()
-        del self.tunnels[cid]
+        channel = self.get_tunnel(cid).channel
+        # Let the target consume what's been uploaded before closing it
+        if not channel.closed:
+            try:
+                await asyncio.wait_for(channel.req.join(), self.poll_timeout)
+            except asyncio.TimeoutError:
+                self.logger.debug("Closing %s with requests still queued", cid)
+        if cid in self.tunnels:
+            self.close_tunnel(cid)
         return web.Response()
 
 
 def create_ssl_context(cafile, certfile, keyfile):
-    ssl_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
-    ssl_context.load_cert_chain(certfile, keyfile)
-    return ssl_context
+    return tls.create_server_context(cafile, certfile, keyfile)
+
+
+async def on_startup_coro(app):
+    tune_event_loop(asyncio.get_running_loop())
+    tracing.setup_tracing(asyncio.get_running_loop())
 
 
 async def on_shutdown_coro(app, handler):
+    # Cancel the long polls forwarded between workers first, the internal
+    # runner would wait for them to complete
     handler.close_all_tunnels()
+    await handler.stop_internal_site()
     # await app.shutdown()
 
 
-def start_tunneld(host, port, reverse=False, cafile=None, certfile=None, keyfile=None):
-    app = web.Application()
-    handler = Handler(app, reverse)
+def serve(host, port, reverse=False, ssl_context=None, worker_id=0, worker_sockets=None):
+    app = web.Application(middlewares=[metrics.server_middleware])
+    handler = Handler(app, reverse, worker_id, worker_sockets)
     on_shutdown = partial(on_shutdown_coro, handler=handler)
+    app.on_startup.append(on_startup_coro)
     app.on_shutdown.append(on_shutdown)
     try:
-        if cafile:
-            ssl_context = create_ssl_context(cafile, certfile, keyfile)
-            web.run_app(app, host=host, port=port, ssl_context=ssl_context, access_log=logger)
-        else:
-            web.run_app(app, host=host, port=port, access_log=logger,
-                        access_log_format='"%r" %s %b %Tf %a - "%{User-agent}i"')
+        # Workers share the listening port, the kernel balancing connections
+        # between them
+        web.run_app(app, host=host, port=port, ssl_context=ssl_context,
+                    reuse_port=bool(worker_sockets), print=None if worker_id else print,
+                    access_log=logging.getLogger(ACCESS_LOGGER),
+                    access_log_format='"%r" %s %b %Tf %a - "%{User-agent}i"')
     except:
         if CONFIG['verbose']:
             logger.critical('Shutdown')
         else:
             logger.info("Shutdown")
+    finally:
+        if worker_sockets:
+            tracing.stop_tracing()
+            stop_logging()
+
+
+def start_tunneld(host, port, reverse=False, cafile=None, certfile=None, keyfile=None,
+                  workers=1):
+    ssl_context = create_ssl_context(cafile, certfile, keyfile) if cafile else None
+    if workers <= 1:
+        serve(host, port, reverse, ssl_context)
+        return
+    sockets = [os.path.join(tempfile.gettempdir(), f'aiotunnel-{os.getpid()}-{i}.sock')
+               for i in range(workers)]
+    # Fork, workers inherit the configuration and the SSL context as they are
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=serve, args=(host, port, reverse, ssl_context, i, sockets))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def terminate_workers(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate_workers)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Workers got the signal too, wait for them to shut down
+        for process in processes:
+            process.join()
+    finally:
+        for path in sockets:
+            if os.path.exists(path):
+                os.unlink(path)
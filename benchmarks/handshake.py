@@ -0,0 +1,170 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""TLS handshake benchmark of tunneld.
+
+Starts a tunneld over TLS with self-signed certificates generated on the fly (requires the
+openssl binary) and opens bursts of new HTTPS connections to it, each one doing a single
+request, the way clients do when a burst of tunnels is opened. Measures with and without
+session resumption:
+
+- connections per second and connection latency percentiles
+- handshakes completed by tunneld and how many resumed a session
+- CPU time spent by tunneld per 1000 connections
+
+Results are written as JSON, e.g.
+
+    $ python benchmarks/handshake.py --connections 2000 --concurrency 50 --output tls.json
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+
+import aiohttp
+
+# Also puts the repository root on the path
+from loopback import SERVER_PORT, generate_certificates, percentile, start_process, wait_port
+
+import aiotunnel
+from aiotunnel import CONFIG, tls
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def cpu_seconds(pid):
+    """User and system CPU time of a process, None where /proc is not available"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+async def server_handshakes(session, url):
+    """Handshakes counted by tunneld as {'yes': resumed, 'no': full}"""
+    counts = {'yes': 0, 'no': 0}
+    async with session.get(f'{url}/metrics') as resp:
+        for line in (await resp.text()).splitlines():
+            if line.startswith('aiotunnel_tls_handshakes_total{side="server"'):
+                resumed = line.split('resumed="')[1].split('"')[0]
+                counts[resumed] = int(float(line.rsplit(' ', 1)[1]))
+    return counts
+
+
+async def run_case(opts, url, cafile, resumption, pid):
+    CONFIG['tls']['session_resumption'] = resumption
+    context = tls.create_client_context(cafile)
+    # A new connection, and handshake, for every request
+    connector = aiohttp.TCPConnector(ssl=context, force_close=True, limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Warm up, the first handshake is always a full one
+        async with session.get(f'{url}/health') as resp:
+            await resp.read()
+        before = await server_handshakes(session, url)
+        cpu = cpu_seconds(pid)
+        semaphore = asyncio.Semaphore(opts.concurrency)
+        latencies = []
+
+        async def connect():
+            async with semaphore:
+                start = time.monotonic()
+                async with session.get(f'{url}/health') as resp:
+                    await resp.read()
+                latencies.append((time.monotonic() - start) * 1000)
+
+        start = time.monotonic()
+        await asyncio.gather(*(connect() for _ in range(opts.connections)))
+        elapsed = time.monotonic() - start
+        cpu = cpu_seconds(pid) - cpu if cpu is not None else None
+        after = await server_handshakes(session, url)
+    return {
+        'session_resumption': resumption,
+        'connections_per_second': round(opts.connections / elapsed, 3),
+        'latency_ms': {f'p{p}': round(percentile(latencies, p), 3) for p in (50, 90, 99)},
+        'handshakes': {'full': after['no'] - before['no'],
+                       'resumed': after['yes'] - before['yes']},
+        'tunneld_cpu_ms_per_1000': round(cpu * 1e6 / opts.connections, 3) if cpu else cpu
+    }
+
+
+async def run(opts):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        tls_args = generate_certificates(workdir)
+        server = start_process(['server', '-a', '127.0.0.1', '-p', str(SERVER_PORT),
+                                '--metrics'] + tls_args + opts.server_args, workdir)
+        try:
+            await wait_port(SERVER_PORT)
+            url = f'https://127.0.0.1:{SERVER_PORT}/aiotunnel'
+            for resumption in (False, True):
+                result = await run_case(opts, url, tls_args[1], resumption, server.pid)
+                print(json.dumps(result))
+                results.append(result)
+        finally:
+            server.terminate()
+            server.wait(10)
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='aiotunnel TLS handshake benchmark')
+    parser.add_argument('--connections', type=int, default=1000,
+                        help='Connections to open for each case')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='Connections being opened at the same time')
+    parser.add_argument('--server-args', type=lambda s: s.split(), default=[],
+                        help='Extra CLI arguments for tunneld, as a single string')
+    parser.add_argument('--output', '-o', help='JSON file to write the results to')
+    return parser
+
+
+def main():
+    opts = get_parser().parse_args()
+    results = asyncio.run(run(opts))
+    report = {
+        'version': aiotunnel.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results
+    }
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
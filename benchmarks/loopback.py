@@ -0,0 +1,281 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Loopback benchmark of aiotunnel.
+
+Starts an echo server, a tunneld and a tunnel client on localhost, the last two as separate
+processes running the aiotunnel CLI, and measures through the tunnel:
+
+- throughput of a bulk stream echoed back, in MB/s
+- round trip latency percentiles of small request/response exchanges
+- connection setup rate, every connection going through a full POST to tunneld
+- peak RSS of the tunneld and tunnel processes
+
+in forward and reverse mode, over plain HTTP and over TLS with self-signed certificates
+generated on the fly (requires the openssl binary). Results are written as JSON to compare
+releases, e.g.
+
+    $ python benchmarks/loopback.py --transport rest ws --output results.json
+
+Passing several loops, e.g. `--loop asyncio uvloop`, compares the event loop implementations
+on the same cases.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import aiotunnel  # noqa: E402
+
+ECHO_PORT = 19001
+SERVER_PORT = 19002
+CLIENT_PORT = 19003
+CLI = 'from aiotunnel.cli import main; main()'
+
+
+def generate_certificates(path):
+    """Generate a CA and a certificate signed by it for 127.0.0.1, used by both sides"""
+    ca_key, ca_crt = os.path.join(path, 'ca.key'), os.path.join(path, 'ca.crt')
+    key, csr, crt = (os.path.join(path, f'cert.{ext}') for ext in ('key', 'csr', 'crt'))
+    ext = os.path.join(path, 'san.ext')
+    with open(ext, 'w') as f:
+        f.write('subjectAltName=IP:127.0.0.1\n')
+    commands = [
+        ['req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj',
+         '/CN=aiotunnel-bench-ca', '-keyout', ca_key, '-out', ca_crt],
+        ['req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=127.0.0.1',
+         '-keyout', key, '-out', csr],
+        ['x509', '-req', '-in', csr, '-CA', ca_crt, '-CAkey', ca_key, '-CAcreateserial',
+         '-days', '1', '-extfile', ext, '-out', crt]
+    ]
+    for command in commands:
+        subprocess.run(['openssl'] + command, check=True, capture_output=True)
+    return ['--ca', ca_crt, '--cert', crt, '--key', key]
+
+
+def peak_rss(pid):
+    """Peak resident set size of a process in KiB, None where /proc is not available"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+async def wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(.1)
+        else:
+            writer.close()
+            return
+    raise RuntimeError(f'Nothing listening on port {port}')
+
+
+async def handle_echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        # Connections still open when the benchmark ends are cancelled
+        pass
+    writer.close()
+
+
+async def read_exactly(reader, size):
+    return await asyncio.wait_for(reader.readexactly(size), 30)
+
+
+async def bench_throughput(size):
+    reader, writer = await asyncio.open_connection('127.0.0.1', CLIENT_PORT)
+    payload = os.urandom(65536)
+    start = time.monotonic()
+
+    async def send():
+        for _ in range(size // len(payload)):
+            writer.write(payload)
+            await writer.drain()
+
+    sender = asyncio.ensure_future(send())
+    await read_exactly(reader, size // len(payload) * len(payload))
+    elapsed = time.monotonic() - start
+    await sender
+    writer.close()
+    return size / elapsed / 1e6
+
+
+async def bench_latency(samples, size=64):
+    reader, writer = await asyncio.open_connection('127.0.0.1', CLIENT_PORT)
+    payload = b'x' * size
+    rtts = []
+    for _ in range(samples):
+        start = time.monotonic()
+        writer.write(payload)
+        await read_exactly(reader, size)
+        rtts.append((time.monotonic() - start) * 1000)
+    writer.close()
+    return {f'p{p}': round(percentile(rtts, p), 3) for p in (50, 90, 99)}
+
+
+async def bench_setup(connections):
+    start = time.monotonic()
+    for _ in range(connections):
+        reader, writer = await asyncio.open_connection('127.0.0.1', CLIENT_PORT)
+        writer.write(b'x')
+        await read_exactly(reader, 1)
+        writer.close()
+    return connections / (time.monotonic() - start)
+
+
+def start_process(args, cwd):
+    return subprocess.Popen([sys.executable, '-c', CLI] + args, cwd=cwd,
+                            env=dict(os.environ, PYTHONPATH=ROOT, LOGPATH=cwd),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def run_case(opts, reverse, tls_args, transport, loop, workdir):
+    mode = ['-r'] if reverse else []
+    tls_args = tls_args + ['--loop', loop]
+    server = start_process(['server', '-a', '127.0.0.1', '-p', str(SERVER_PORT)] + mode +
+                           tls_args + opts.server_args, workdir)
+    client = None
+    try:
+        await wait_port(SERVER_PORT)
+        client = start_process(['client', '-p', str(CLIENT_PORT), '-sa', '127.0.0.1',
+                                '-sp', str(SERVER_PORT), '-A', '127.0.0.1',
+                                '-P', str(ECHO_PORT), '-t', transport] + mode +
+                               tls_args + opts.client_args, workdir)
+        # The endpoint is opened by the client in forward mode, by tunneld
+        # once the client registered in reverse mode
+        await wait_port(CLIENT_PORT)
+        result = {
+            'mode': 'reverse' if reverse else 'forward',
+            'tls': '--ca' in tls_args,
+            'transport': transport,
+            'loop': loop,
+            'throughput_mbps': round(await bench_throughput(opts.size * 1024 * 1024), 3),
+            'latency_ms': await bench_latency(opts.samples),
+        }
+        result['connections_per_second'] = round(await bench_setup(opts.connections), 3)
+        result['peak_rss_kb'] = {'tunneld': peak_rss(server.pid), 'tunnel': peak_rss(client.pid)}
+        return result
+    finally:
+        for process in (client, server):
+            if process:
+                process.terminate()
+                process.wait(10)
+
+
+async def run(opts):
+    echo = await asyncio.start_server(handle_echo, '127.0.0.1', ECHO_PORT)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        tls_modes = [[]]
+        if opts.tls:
+            tls_modes.append(generate_certificates(workdir))
+        for reverse in {'forward': [False], 'reverse': [True],
+                        'both': [False, True]}[opts.mode]:
+            for tls_args in tls_modes:
+                for transport in opts.transport:
+                    for loop in opts.loop:
+                        result = await run_case(opts, reverse, tls_args, transport, loop,
+                                                workdir)
+                        print(json.dumps(result))
+                        results.append(result)
+    echo.close()
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='aiotunnel loopback benchmark')
+    parser.add_argument('--mode', choices=('forward', 'reverse', 'both'), default='both',
+                        help='Tunnel direction to benchmark')
+    parser.add_argument('--transport', nargs='+', default=['rest'],
+                        help='Client transports to benchmark')
+    parser.add_argument('--loop', nargs='+', default=['asyncio'],
+                        help='Event loops to benchmark, asyncio and/or uvloop')
+    parser.add_argument('--tls', action='store_true', help='Also benchmark over TLS')
+    parser.add_argument('--size', type=int, default=64, help='MiB to stream for throughput')
+    parser.add_argument('--samples', type=int, default=1000,
+                        help='Round trips for the latency percentiles')
+    parser.add_argument('--connections', type=int, default=200,
+                        help='Connections to open for the setup rate')
+    parser.add_argument('--server-args', type=shlex.split, default=[],
+                        help='Extra CLI arguments for tunneld, as a single string')
+    parser.add_argument('--client-args', type=shlex.split, default=[],
+                        help='Extra CLI arguments for the tunnel client, as a single string')
+    parser.add_argument('--output', '-o', help='JSON file to write the results to')
+    return parser
+
+
+def main():
+    opts = get_parser().parse_args()
+    results = asyncio.run(run(opts))
+    report = {
+        'version': aiotunnel.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results
+    }
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Memory benchmark of idle tunnels.
+
+Starts a tunneld, opens batches of tunnels to a local target that greets every connection
+with a few bytes, fetched once with a GET as a client would, then left idle. Reports the growth
+of the tunneld resident set size divided by the number of open tunnels, i.e. the bytes each
+idle tunnel costs, target socket included, --payload 0 measuring tunnels that never carried
+any data.
+Every tunnel takes a file descriptor in tunneld and in the benchmark process, the soft limit
+is raised to the hard one, which must allow the largest session count, e.g.
+
+    $ ulimit -n 250000
+    $ python benchmarks/memory.py --sessions 10000 100000 --output memory.json
+"""
+
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+
+import aiohttp
+
+# Also puts the repository root on the path
+from loopback import ECHO_PORT, SERVER_PORT, start_process, wait_port
+
+import aiotunnel
+from aiotunnel.protocol import ACK_HEADER
+
+# Most tunnels opened by a single POST
+BATCH = 64
+
+
+def rss(pid):
+    """Resident set size of a process in bytes"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('VmRSS not available')
+
+
+async def open_tunnels(session, url, count, concurrency=16):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def open_batch(size):
+        async with semaphore:
+            async with session.post(url, data=f'127.0.0.1:{ECHO_PORT}',
+                                    params={'count': str(size)}) as resp:
+                resp.raise_for_status()
+                return (await resp.text()).split()
+
+    sizes = [BATCH] * (count // BATCH) + ([count % BATCH] if count % BATCH else [])
+    batches = await asyncio.gather(*(open_batch(size) for size in sizes))
+    return [cid for cids in batches for cid in cids]
+
+
+async def fetch_greetings(session, url, cids, concurrency=64):
+    """GET once every tunnel, acknowledging nothing yet like the first poll of a client"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(cid):
+        async with semaphore:
+            async with session.get(f'{url}/{cid}', headers={ACK_HEADER: '0'}) as resp:
+                resp.raise_for_status()
+                await resp.read()
+
+    await asyncio.gather(*(fetch(cid) for cid in cids))
+
+
+async def run_case(sessions, payload, workdir, server_args):
+    # Accepted target connections send their greeting, then are kept open
+    # and idle until the end
+    targets = []
+    greeting = b'x' * payload
+
+    def accept(reader, writer):
+        if greeting:
+            writer.write(greeting)
+        targets.append(writer)
+
+    target = await asyncio.start_server(accept, '127.0.0.1', ECHO_PORT, backlog=4096)
+    server = start_process(['server', '-a', '127.0.0.1', '-p', str(SERVER_PORT)] + server_args,
+                           workdir)
+    try:
+        await wait_port(SERVER_PORT)
+        url = f'http://127.0.0.1:{SERVER_PORT}/aiotunnel'
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Warm up, the first tunnels pay for the modules and pools
+            # touched once
+            warmup = await open_tunnels(session, url, BATCH)
+            if greeting:
+                await fetch_greetings(session, url, warmup)
+            await asyncio.sleep(1)
+            before = rss(server.pid)
+            start = time.monotonic()
+            cids = await open_tunnels(session, url, sessions)
+            if greeting:
+                await fetch_greetings(session, url, cids)
+            elapsed = time.monotonic() - start
+            await asyncio.sleep(1)
+            after = rss(server.pid)
+        opened = len(cids)
+        return {
+            'sessions': opened,
+            'payload': payload,
+            'open_seconds': round(elapsed, 3),
+            'tunneld_rss_kb': after // 1024,
+            'bytes_per_tunnel': (after - before) // opened
+        }
+    finally:
+        server.terminate()
+        server.wait(10)
+        for writer in targets:
+            writer.close()
+        target.close()
+        await target.wait_closed()
+
+
+async def run(opts):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for sessions in opts.sessions:
+            result = await run_case(sessions, opts.payload, workdir, opts.server_args)
+            print(json.dumps(result))
+            results.append(result)
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='aiotunnel idle tunnels memory benchmark')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000, 100000],
+                        help='Idle tunnels to open in each case')
+    parser.add_argument('--payload', type=int, default=100,
+                        help='Bytes sent by the target on every tunnel before it goes idle')
+    parser.add_argument('--server-args', type=lambda s: s.split(), default=[],
+                        help='Extra CLI arguments for tunneld, as a single string')
+    parser.add_argument('--output', '-o', help='JSON file to write the results to')
+    return parser
+
+
+def main():
+    opts = get_parser().parse_args()
+    # tunneld inherits the limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < max(opts.sessions) + 1024:
+        raise SystemExit(f'{max(opts.sessions)} sessions need a higher file descriptor '
+                         f'limit than {hard}, raise it with ulimit -n')
+    results = asyncio.run(run(opts))
+    report = {
+        'version': aiotunnel.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results
+    }
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,5 +14,6 @@ setup(
     author_email='a.g.baldan@gmail.com',
     packages=['aiotunnel'],
     install_requires=required,
+    extras_require={'uvloop': ['uvloop']},
     scripts=['scripts/aiotunnel']
 )
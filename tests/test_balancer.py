@@ -0,0 +1,118 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import unittest
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from aiotunnel.balancer import Balancer, Server
+
+
+class ServerTest(unittest.TestCase):
+
+    def test_latency_average(self):
+        server = Server('http://a')
+        server.succeeded(0, 1.0)
+        self.assertEqual(server.latency, 1.0)
+        server.succeeded(0, 2.0)
+        self.assertAlmostEqual(server.latency, 1.3)
+
+    def test_circuit_breaker(self):
+        server = Server('http://a', failure_threshold=2, reset_timeout=10)
+        self.assertFalse(server.failed(0))
+        self.assertTrue(server.failed(1))
+        self.assertFalse(server.available)
+        # Too early to trust it again
+        self.assertFalse(server.succeeded(5))
+        self.assertFalse(server.available)
+        self.assertTrue(server.succeeded(11))
+        self.assertTrue(server.available)
+
+
+class BalancerTest(unittest.IsolatedAsyncioTestCase):
+
+    URLS = ['http://a', 'http://b', 'http://c']
+
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    def urls(self, balancer):
+        return [server.url for server in balancer.candidates()]
+
+    async def test_latency_policy(self):
+        balancer = Balancer(self.URLS, self.session)
+        balancer.succeeded('http://b', 0.01)
+        balancer.succeeded('http://c', 0.1)
+        # Never measured, last
+        self.assertEqual(self.urls(balancer), ['http://b', 'http://c', 'http://a'])
+
+    async def test_tunnels_policy(self):
+        balancer = Balancer(self.URLS, self.session, policy='tunnels')
+        balancer.placed('http://a', 0.01, count=2)
+        balancer.placed('http://b', 0.01)
+        self.assertEqual(self.urls(balancer), ['http://c', 'http://b', 'http://a'])
+
+    async def test_place_waits_for_recovery(self):
+        balancer = Balancer(self.URLS[:1], self.session, failure_threshold=1, reset_timeout=0)
+        balancer.failed('http://a')
+        self.assertFalse(balancer.available('http://a'))
+        place = asyncio.ensure_future(balancer.place())
+        await asyncio.sleep(0)
+        self.assertFalse(place.done())
+        balancer.succeeded('http://a')
+        servers = await asyncio.wait_for(place, 1)
+        self.assertEqual([server.url for server in servers], ['http://a'])
+
+    async def test_health_check(self):
+        async def health(request):
+            return web.Response(text='7')
+
+        app = web.Application()
+        app.router.add_get('/aiotunnel/health', health)
+        async with TestServer(app) as server:
+            url = str(server.make_url('/aiotunnel'))
+            balancer = Balancer([url], self.session)
+            await balancer.check(balancer.servers[url])
+            self.assertEqual(balancer.servers[url].tunnels, 7)
+            self.assertIsNotNone(balancer.servers[url].latency)
+        balancer = Balancer([url], self.session, failure_threshold=1)
+        # Nothing listening anymore
+        await balancer.check(balancer.servers[url])
+        self.assertFalse(balancer.available(url))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from aiotunnel.buffers import BufferPool, BufferReader, COPY_SIZE
+
+
+def read(reader, data):
+    """Simulate a transport reading data into the buffer of reader"""
+    view = reader.get_buffer(-1)
+    view[:len(data)] = data
+    view.release()
+    return reader.buffer_updated(len(data))
+
+
+class BufferReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = BufferPool(size_classes=(16384, 65536), max_free=2)
+        self.reader = BufferReader(self.pool)
+
+    def test_small_read_copied(self):
+        chunk = read(self.reader, b'x' * (COPY_SIZE - 1))
+        self.assertIsInstance(chunk, bytes)
+        # Recycled right away, the idle reader holds no buffer
+        self.assertIsNone(self.reader.buffer)
+        self.assertEqual(len(self.pool.free[16384]), 1)
+
+    def test_chunks_share_buffer(self):
+        first = read(self.reader, b'a' * 4096)
+        second = read(self.reader, b'b' * 4096)
+        self.assertIs(first.obj, second.obj)
+        buf = first.obj
+        self.assertEqual(buf.refs, 2)
+        # Reads landing in a buffer still in use aren't copied
+        self.assertIsInstance(read(self.reader, b'c'), memoryview)
+        self.assertEqual(bytes(second), b'b' * 4096)
+
+    def test_recycled_once_all_released(self):
+        chunks = [read(self.reader, b'a' * 4096) for _ in range(2)]
+        buf = chunks[0].obj
+        self.pool.release(chunks[0])
+        self.assertFalse(self.pool.free[16384])
+        self.pool.release(chunks[1])
+        self.assertEqual(self.pool.free[16384], [buf])
+        self.assertIsNone(self.reader.buffer)
+        self.assertIsNone(buf.reader)
+        # Reused by the next read under a new lease
+        lease = buf.lease
+        chunk = read(self.reader, b'b' * 4096)
+        self.assertIs(chunk.obj, buf)
+        self.assertNotEqual(buf.lease, lease)
+
+    def test_release_twice(self):
+        chunk = read(self.reader, b'a' * 4096)
+        self.pool.release(chunk)
+        self.pool.release(chunk)
+        self.pool.release(b'not pooled')
+        self.assertEqual(len(self.pool.free[16384]), 1)
+
+    def test_grows_when_filled(self):
+        chunk = read(self.reader, b'a' * 16384)
+        self.assertEqual(len(chunk.obj), 16384)
+        self.pool.release(chunk)
+        chunk = read(self.reader, b'a' * 4096)
+        self.assertEqual(len(chunk.obj), 65536)
+
+    def test_max_free(self):
+        readers = [BufferReader(self.pool) for _ in range(3)]
+        chunks = [read(reader, b'a' * 4096) for reader in readers]
+        for chunk in chunks:
+            self.pool.release(chunk)
+        self.assertEqual(len(self.pool.free[16384]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import zlib
+import unittest
+
+from aiotunnel.compression import Compressor, decompress, RAW, ZLIB
+
+TEXT = b'SELECT id, name FROM users WHERE id = 1;\n' * 100
+
+
+class CompressorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        compressor = Compressor(threshold=1024)
+        for data in (TEXT, os.urandom(4096), b'small'):
+            self.assertEqual(decompress(compressor.compress(data)), data)
+
+    def test_compressible(self):
+        payload = Compressor().compress(TEXT)
+        self.assertEqual(payload[:1], ZLIB)
+        self.assertLess(len(payload), len(TEXT))
+
+    def test_small_sent_raw(self):
+        self.assertEqual(Compressor(threshold=1024).compress(b'x' * 1023), RAW + b'x' * 1023)
+
+    def test_incompressible_sent_raw(self):
+        data = os.urandom(4096)
+        self.assertEqual(Compressor().compress(data), RAW + data)
+
+    def test_backoff(self):
+        compressor = Compressor(window=4, backoff=3)
+        for _ in range(4):
+            compressor.compress(os.urandom(4096))
+        # Incompressible stream, not even tried for the next backoff chunks
+        self.assertEqual(compressor.skip, 3)
+        for _ in range(3):
+            self.assertEqual(compressor.compress(TEXT)[:1], RAW)
+        self.assertEqual(compressor.compress(TEXT)[:1], ZLIB)
+
+
+class DecompressTest(unittest.TestCase):
+
+    def test_max_size(self):
+        payload = ZLIB + zlib.compress(b'\x00' * 100000)
+        self.assertEqual(len(decompress(payload, 100000)), 100000)
+        # A small chunk expanding way beyond what would ever be buffered
+        with self.assertRaises(ValueError):
+            decompress(payload, 99999)
+
+    def test_corrupted(self):
+        with self.assertRaises(ValueError):
+            decompress(ZLIB + b'not zlib at all')
+
+    def test_truncated(self):
+        payload = ZLIB + zlib.compress(TEXT)
+        with self.assertRaises(ValueError):
+            decompress(payload[:-10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from aiotunnel.mux import pack_frame, unpack_frames, HEADER, OPEN, DATA, CLOSE, WINDOW, CREDIT
+from aiotunnel.tunneld import Handler
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        frames = [
+            (1, OPEN, b'127.0.0.1:22'),
+            (1, DATA, b'\x00' * 70000),
+            (2, DATA, b'ssh'),
+            (1, WINDOW, CREDIT.pack(65536)),
+            (2, CLOSE, b'')
+        ]
+        message = b''.join(pack_frame(*frame) for frame in frames)
+        self.assertEqual(list(unpack_frames(message)), frames)
+
+    def test_empty_payload(self):
+        frame = pack_frame(7, CLOSE)
+        self.assertEqual(len(frame), HEADER.size)
+        self.assertEqual(list(unpack_frames(frame)), [(7, CLOSE, b'')])
+
+    def test_flags_combine(self):
+        message = pack_frame(3, DATA | CLOSE, b'bye')
+        ((stream_id, flags, payload),) = unpack_frames(message)
+        self.assertEqual((stream_id, payload), (3, b'bye'))
+        self.assertTrue(flags & DATA and flags & CLOSE)
+        self.assertFalse(flags & OPEN)
+
+    def test_max_stream_id(self):
+        message = pack_frame(2 ** 32 - 1, DATA, b'x')
+        self.assertEqual(list(unpack_frames(message)), [(2 ** 32 - 1, DATA, b'x')])
+
+
+class MuxHandlerTest(unittest.IsolatedAsyncioTestCase):
+
+    """Streams multiplexed over a WebSocket to tunneld, with a target counting what every
+    connection receives"""
+
+    async def asyncSetUp(self):
+        self.received = asyncio.Queue()
+
+        async def target(reader, writer):
+            data = await reader.read()
+            self.received.put_nowait(len(data))
+            writer.close()
+
+        self.target = await asyncio.start_server(target, '127.0.0.1', 0)
+        self.service = f'127.0.0.1:{self.target.sockets[0].getsockname()[1]}'.encode()
+        app = web.Application()
+        self.handler = Handler(app)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.target.close()
+        await self.target.wait_closed()
+
+    async def test_close_delivers_queued_data(self):
+        async with self.client.ws_connect('/aiotunnel/mux') as ws:
+            # Closed before the target connections are even open
+            for stream_id in range(1, 11):
+                await ws.send_bytes(pack_frame(stream_id, OPEN, self.service) +
+                                    pack_frame(stream_id, DATA, b'x' * 5000) +
+                                    pack_frame(stream_id, CLOSE))
+            received = [await asyncio.wait_for(self.received.get(), 5) for _ in range(10)]
+        self.assertEqual(received, [5000] * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
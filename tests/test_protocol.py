@@ -0,0 +1,116 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import socket
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from aiotunnel import CONFIG
+from aiotunnel.tunnel import run_tunnel
+from aiotunnel.tunneld import Handler
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class WriteTest(unittest.IsolatedAsyncioTestCase):
+
+    """Writes of a rest tunnel to a tunneld answering PUTs slowly, with a target collecting
+    everything it receives"""
+
+    PUT_DELAY = 1
+
+    async def asyncSetUp(self):
+        self.received = asyncio.get_running_loop().create_future()
+
+        async def target(reader, writer):
+            self.received.set_result(await reader.read())
+            writer.close()
+
+        @web.middleware
+        async def slow_puts(request, handler):
+            if request.method == 'PUT':
+                await asyncio.sleep(self.PUT_DELAY)
+            return await handler(request)
+
+        self.target = await asyncio.start_server(target, '127.0.0.1', 0)
+        self.target_port = self.target.sockets[0].getsockname()[1]
+        app = web.Application(middlewares=[slow_puts])
+        self.handler = Handler(app)
+        self.handler.poll_timeout = 0.5
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/aiotunnel'
+
+    async def asyncTearDown(self):
+        for cid in list(self.handler.tunnels):
+            self.handler.close_tunnel(cid)
+        await self.runner.cleanup()
+        self.target.close()
+        await self.target.wait_closed()
+
+    async def test_close_while_coalescing(self):
+        port = free_port()
+        forwarding = (('127.0.0.1', port), ('127.0.0.1', self.target_port), False)
+        options = {'transport': 'rest', 'flush_delay': 400000}
+        with mock.patch.dict(CONFIG['client'], options):
+            tunnel = asyncio.ensure_future(run_tunnel([self.url], [forwarding]))
+            try:
+                for _ in range(50):
+                    try:
+                        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                        break
+                    except OSError:
+                        await asyncio.sleep(0.1)
+                # Sent from 0.4s to 1.4s, the second batch waiting for more
+                # data from 1.2s to 1.6s as the first PUT completes and the
+                # connection closes
+                writer.write(b'first')
+                await asyncio.sleep(1.2)
+                writer.write(b'second')
+                await asyncio.sleep(0.05)
+                writer.close()
+                received = await asyncio.wait_for(self.received, 5)
+                self.assertEqual(received, b'firstsecond')
+            finally:
+                tunnel.cancel()
+                await asyncio.gather(tunnel, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
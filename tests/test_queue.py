@@ -0,0 +1,114 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import unittest
+
+from aiotunnel.protocol import ChunkQueue, Flag
+
+
+class FlagTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_wait_set(self):
+        flag = Flag()
+        waiter = asyncio.ensure_future(flag.wait())
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        flag.set()
+        self.assertTrue(await waiter)
+        # No waiter left behind
+        self.assertIsNone(flag.waiters)
+
+    async def test_set_returns_right_away(self):
+        flag = Flag(True)
+        self.assertTrue(await flag.wait())
+        flag.clear()
+        self.assertFalse(flag.is_set())
+
+    async def test_cancelled_waiter(self):
+        flag = Flag()
+        waiter = asyncio.ensure_future(flag.wait())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertIsNone(flag.waiters)
+
+
+class ChunkQueueTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_fifo(self):
+        queue = ChunkQueue()
+        for chunk in (b'a', b'b', b'c'):
+            queue.put_nowait(chunk)
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual([await queue.get() for _ in range(3)], [b'a', b'b', b'c'])
+        self.assertTrue(queue.empty())
+        with self.assertRaises(asyncio.QueueEmpty):
+            queue.get_nowait()
+
+    async def test_drained_queue_holds_no_containers(self):
+        queue = ChunkQueue()
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        self.assertIsNotNone(queue.getters)
+        queue.put_nowait(b'a')
+        self.assertEqual(await getter, b'a')
+        self.assertIsNone(queue.items)
+        self.assertIsNone(queue.getters)
+
+    async def test_cancelled_getter_loses_nothing(self):
+        queue = ChunkQueue()
+        first = asyncio.ensure_future(queue.get())
+        second = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        # Woken up with the item, then cancelled before running
+        queue.put_nowait(b'a')
+        first.cancel()
+        self.assertEqual(await second, b'a')
+        self.assertTrue(first.cancelled())
+
+    async def test_join(self):
+        queue = ChunkQueue()
+        await asyncio.wait_for(queue.join(), 1)
+        queue.put_nowait(b'a')
+        queue.put_nowait(b'b')
+        joined = asyncio.ensure_future(queue.join())
+        queue.get_nowait()
+        queue.task_done()
+        await asyncio.sleep(0)
+        self.assertFalse(joined.done())
+        queue.get_nowait()
+        queue.task_done()
+        await asyncio.wait_for(joined, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
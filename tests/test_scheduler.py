@@ -0,0 +1,104 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import unittest
+
+from aiotunnel import CONFIG
+from aiotunnel.scheduler import Scheduler, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(1000, 500, 0)
+        self.assertEqual(bucket.take(500, 0), 0)
+        # In debt, waiting for it to be paid back
+        self.assertEqual(bucket.take(250, 0), 0.25)
+
+    def test_refill(self):
+        bucket = TokenBucket(1000, 500, 0)
+        bucket.take(500, 0)
+        self.assertEqual(bucket.take(100, 0.1), 0)
+        # Never more than burst tokens, however long it's been idle
+        bucket.take(0, 100)
+        self.assertEqual(bucket.tokens, 500)
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    def test_nothing_to_enforce(self):
+        self.assertIsNone(Scheduler.from_config('up', CONFIG['server']))
+
+    async def test_tunnel_rate(self):
+        scheduler = Scheduler('up', tunnel_rate=100000, tunnel_burst=1000)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await scheduler.transmit('a', '10.0.0.1', 1000)
+        self.assertLess(loop.time() - start, 0.05)
+        await scheduler.transmit('a', '10.0.0.1', 10000)
+        self.assertGreaterEqual(loop.time() - start, 0.09)
+        # Other tunnels have buckets of their own
+        start = loop.time()
+        await scheduler.transmit('b', '10.0.0.1', 1000)
+        self.assertLess(loop.time() - start, 0.05)
+
+    async def test_client_rate(self):
+        scheduler = Scheduler('up', client_rate=100000, client_burst=1000)
+        loop = asyncio.get_running_loop()
+        await scheduler.transmit('a', '10.0.0.1', 1000)
+        # Sharing the bucket of the client
+        start = loop.time()
+        await scheduler.transmit('b', '10.0.0.1', 10000)
+        self.assertGreaterEqual(loop.time() - start, 0.09)
+        self.assertEqual(scheduler.clients['10.0.0.1'][1], 2)
+        scheduler.forget('a')
+        scheduler.forget('b')
+        self.assertFalse(scheduler.clients)
+        self.assertFalse(scheduler.flows)
+
+    async def test_small_chunks_not_queued_behind_bulk(self):
+        scheduler = Scheduler('down', bandwidth=10 ** 9, quantum=1024)
+        done = []
+
+        async def transmit(key, size):
+            await scheduler.transmit(key, '10.0.0.1', size)
+            done.append(key)
+
+        bulk = asyncio.ensure_future(transmit('bulk', 64 * 1024))
+        # Let the bulk transfer take its first turns
+        await asyncio.sleep(0)
+        await transmit('interactive', 100)
+        await bulk
+        self.assertEqual(done, ['interactive', 'bulk'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import socket
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from aiotunnel import CONFIG
+from aiotunnel.tunnel import run_tunnel
+from aiotunnel.tunneld import Handler
+
+# Compressible and incompressible data, both paths of the compressor
+PAYLOAD = b'aiotunnel ' * 20000 + os.urandom(100000)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class RoundTripTest(unittest.IsolatedAsyncioTestCase):
+
+    """Data echoed by a target through a tunneld and a tunnel client running in process, for
+    every transport with and without compression"""
+
+    async def asyncSetUp(self):
+        async def echo(reader, writer):
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        self.target = await asyncio.start_server(echo, '127.0.0.1', 0)
+        self.target_port = self.target.sockets[0].getsockname()[1]
+        app = web.Application()
+        self.handler = Handler(app, reverse=True)
+        # Pending long polls hold the cleanup of the runner
+        self.handler.poll_timeout = 0.5
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/aiotunnel'
+
+    async def asyncTearDown(self):
+        for cid in list(self.handler.tunnels):
+            self.handler.close_tunnel(cid)
+        await self.runner.cleanup()
+        self.target.close()
+        await self.target.wait_closed()
+
+    async def connect(self, port):
+        # The endpoint takes a moment to open, on the server in reverse mode
+        for _ in range(50):
+            try:
+                return await asyncio.open_connection('127.0.0.1', port)
+            except OSError:
+                await asyncio.sleep(0.1)
+        self.fail(f'Endpoint {port} never opened')
+
+    async def round_trip(self, transport, compression, reverse=False, **options):
+        options.update(transport=transport, compression=compression)
+        port = free_port()
+        forwarding = (('127.0.0.1', port), ('127.0.0.1', self.target_port), reverse)
+        with mock.patch.dict(CONFIG['client'], options):
+            tunnel = asyncio.ensure_future(run_tunnel([self.url], [forwarding]))
+            try:
+                for _ in range(2):
+                    reader, writer = await self.connect(port)
+                    writer.write(PAYLOAD)
+                    received = await asyncio.wait_for(reader.readexactly(len(PAYLOAD)), 10)
+                    self.assertEqual(received, PAYLOAD)
+                    writer.close()
+            finally:
+                tunnel.cancel()
+                await asyncio.gather(tunnel, return_exceptions=True)
+
+    async def test_forward(self):
+        for transport in ('rest', 'ws', 'stream', 'mux'):
+            for compression in (False, True):
+                with self.subTest(transport=transport, compression=compression):
+                    await self.round_trip(transport, compression)
+
+    async def test_reverse(self):
+        for transport in ('rest', 'ws', 'stream', 'mux'):
+            for compression in (False, True):
+                with self.subTest(transport=transport, compression=compression):
+                    await self.round_trip(transport, compression, reverse=True)
+
+    async def test_pool(self):
+        for transport in ('rest', 'ws', 'stream'):
+            for compression in (False, True):
+                with self.subTest(transport=transport, compression=compression):
+                    await self.round_trip(transport, compression, tunnel_pool_size=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,279 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Andrea Giacomo Baldan
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import socket
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from aiotunnel import CONFIG
+from aiotunnel.tunnel import open_endpoint
+from aiotunnel.tunneld import Channel, Handler, Lease, REORDER_WINDOW
+from aiotunnel.balancer import Balancer
+from aiotunnel.protocol import SEQ_HEADER, ACK_HEADER, OFFSET_HEADER
+
+
+def queued_requests(channel):
+    requests = []
+    while not channel.req.empty():
+        requests.append(channel.req.get_nowait())
+    return requests
+
+
+class SequencedTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_in_order(self):
+        channel = Channel()
+        for seq in range(3):
+            self.assertTrue(await channel.push_sequenced(seq, bytes([seq])))
+        self.assertEqual(queued_requests(channel), [b'\x00', b'\x01', b'\x02'])
+
+    async def test_out_of_order(self):
+        channel = Channel()
+        self.assertTrue(await channel.push_sequenced(2, b'c'))
+        self.assertTrue(await channel.push_sequenced(1, b'b'))
+        # Held until the missing one comes in
+        self.assertTrue(channel.req.empty())
+        self.assertTrue(await channel.push_sequenced(0, b'a'))
+        self.assertEqual(queued_requests(channel), [b'a', b'b', b'c'])
+        self.assertEqual(channel.next_seq, 3)
+        self.assertFalse(channel.reorder)
+
+    async def test_duplicates(self):
+        channel = Channel()
+        await channel.push_sequenced(0, b'a')
+        # Already delivered
+        self.assertTrue(await channel.push_sequenced(0, b'a'))
+        await channel.push_sequenced(2, b'c')
+        # Already held
+        self.assertTrue(await channel.push_sequenced(2, b'c'))
+        await channel.push_sequenced(1, b'b')
+        self.assertEqual(queued_requests(channel), [b'a', b'b', b'c'])
+
+    async def test_beyond_window(self):
+        channel = Channel()
+        self.assertFalse(await channel.push_sequenced(REORDER_WINDOW, b'x'))
+        self.assertTrue(await channel.push_sequenced(REORDER_WINDOW - 1, b'x'))
+        self.assertTrue(channel.req.empty())
+
+
+class AcknowledgeTest(unittest.IsolatedAsyncioTestCase):
+
+    async def pull(self, channel):
+        return await channel.pull_responses(65536, 1)
+
+    async def test_lost_response_sent_again(self):
+        channel = Channel()
+        self.assertIsNone(channel.acknowledge(0))
+        channel.push_response_nowait(b'hello')
+        self.assertEqual(await self.pull(channel), b'hello')
+        # The response never made it, the client asks from offset 0 again
+        self.assertEqual(channel.acknowledge(0), (0, b'hello'))
+        channel.push_response_nowait(b' world')
+        self.assertEqual(await self.pull(channel), b' world')
+        # Only the first part made it
+        self.assertEqual(channel.acknowledge(3), (0, b'hello world'))
+        self.assertEqual(channel.acknowledge(5), (5, b' world'))
+        self.assertIsNone(channel.acknowledge(11))
+        self.assertFalse(channel.unacked)
+
+    async def test_no_acks_nothing_kept(self):
+        channel = Channel()
+        channel.push_response_nowait(b'hello')
+        self.assertEqual(await self.pull(channel), b'hello')
+        self.assertFalse(channel.unacked)
+        self.assertEqual(channel.sent, 5)
+
+
+class HandlerTest(unittest.IsolatedAsyncioTestCase):
+
+    """Requests to tunneld with a target greeting every connection"""
+
+    GREETING = b'SSH-2.0-test\r\n'
+
+    async def asyncSetUp(self):
+        self.received = asyncio.Queue()
+
+        async def target(reader, writer):
+            writer.write(self.GREETING)
+            while data := await reader.read(65536):
+                self.received.put_nowait(data)
+            writer.close()
+
+        self.target = await asyncio.start_server(target, '127.0.0.1', 0)
+        self.target_port = self.target.sockets[0].getsockname()[1]
+        app = web.Application()
+        self.handler = Handler(app)
+        self.handler.poll_timeout = 0.1
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        resp = await self.client.post('/aiotunnel', data=f'127.0.0.1:{self.target_port}')
+        self.assertEqual(resp.status, 200)
+        self.cid = await resp.text()
+
+    async def asyncTearDown(self):
+        for cid in list(self.handler.tunnels):
+            self.handler.close_tunnel(cid)
+        await self.client.close()
+        self.target.close()
+        await self.target.wait_closed()
+
+    async def put(self, seq, data):
+        return await self.client.put(f'/aiotunnel/{self.cid}', data=data,
+                                     headers={SEQ_HEADER: str(seq)})
+
+    async def get(self, ack):
+        resp = await self.client.get(f'/aiotunnel/{self.cid}', headers={ACK_HEADER: str(ack)})
+        return resp.status, resp.headers.get(OFFSET_HEADER), await resp.read()
+
+    async def test_put_reordered(self):
+        for seq, data in ((1, b'b'), (2, b'c'), (1, b'b'), (0, b'a')):
+            self.assertEqual((await self.put(seq, data)).status, 200)
+        received = b''
+        while len(received) < 3:
+            received += await asyncio.wait_for(self.received.get(), 1)
+        self.assertEqual(received, b'abc')
+
+    async def test_put_beyond_window(self):
+        resp = await self.put(REORDER_WINDOW, b'x')
+        self.assertEqual(resp.status, 503)
+        # Accepted once the missing ones are in
+        self.assertEqual((await self.put(REORDER_WINDOW - 1, b'x')).status, 200)
+
+    async def test_get_resends_from_lost_offset(self):
+        self.assertEqual(await self.get(0), (200, '0', self.GREETING))
+        # The response got lost, asked again from the same offset
+        self.assertEqual(await self.get(0), (200, '0', self.GREETING))
+        # Partly received
+        self.assertEqual(await self.get(4), (200, '0', self.GREETING))
+        # All received, nothing new to read
+        self.assertEqual((await self.get(len(self.GREETING)))[0], 204)
+
+
+class EndpointTest(unittest.IsolatedAsyncioTestCase):
+
+    """Reverse endpoints opened on a port already taken"""
+
+    async def asyncSetUp(self):
+        self.taken = socket.socket()
+        self.taken.bind(('127.0.0.1', 0))
+        self.taken.listen()
+        self.port = self.taken.getsockname()[1]
+        app = web.Application()
+        self.handler = Handler(app, reverse=True)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.taken.close()
+
+    async def test_conflict(self):
+        resp = await self.client.post('/aiotunnel', data=f'127.0.0.1:{self.port}')
+        self.assertEqual(resp.status, 409)
+        self.assertFalse(self.handler.accepts)
+        self.assertFalse(self.handler.tunnels)
+
+    async def test_server_not_ejected(self):
+        url = str(self.client.make_url('/aiotunnel'))
+        balancer = Balancer([url], self.client.session, failure_threshold=1)
+        self.assertIs(await open_endpoint(balancer, self.client.session,
+                                          f'127.0.0.1:{self.port}'), False)
+        self.assertTrue(balancer.available(url))
+
+
+class ReaperTest(unittest.IsolatedAsyncioTestCase):
+
+    """Tunnels to a silent target expired by the reaper"""
+
+    async def asyncSetUp(self):
+        async def target(reader, writer):
+            await reader.read()
+            writer.close()
+
+        self.target = await asyncio.start_server(target, '127.0.0.1', 0)
+        self.service = f'127.0.0.1:{self.target.sockets[0].getsockname()[1]}'
+
+    async def asyncTearDown(self):
+        for cid in list(self.handler.tunnels):
+            self.handler.close_tunnel(cid)
+        await self.client.close()
+        self.target.close()
+        await self.target.wait_closed()
+
+    async def start(self, idle_timeout=0, max_lifetime=0):
+        options = {'idle_timeout': idle_timeout, 'max_lifetime': max_lifetime}
+        with mock.patch.dict(CONFIG['server'], options):
+            app = web.Application()
+            self.handler = Handler(app)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        resp = await self.client.post('/aiotunnel', data=self.service)
+        return await resp.text()
+
+    async def get(self, cid):
+        resp = await self.client.get(f'/aiotunnel/{cid}')
+        return resp.status
+
+    async def test_deadline(self):
+        await self.start(idle_timeout=10, max_lifetime=15)
+        lease = Lease(100)
+        self.assertEqual(self.handler.deadline_of(lease, 108), 110)
+        # A request attached keeps it from going idle
+        lease.attached = 1
+        self.assertEqual(self.handler.deadline_of(lease, 108), 115)
+
+    async def test_idle(self):
+        cid = await self.start(idle_timeout=0.2)
+        await asyncio.sleep(0.5)
+        self.assertNotIn(cid, self.handler.tunnels)
+        self.assertEqual(await self.get(cid), 410)
+
+    async def test_long_poll_not_idle(self):
+        cid = await self.start(idle_timeout=0.2)
+        # Attached for longer than the idle timeout
+        self.handler.poll_timeout = 0.5
+        self.assertEqual(await self.get(cid), 204)
+        self.assertIn(cid, self.handler.tunnels)
+
+    async def test_max_lifetime(self):
+        cid = await self.start(max_lifetime=0.4)
+        self.handler.poll_timeout = 0.1
+        for _ in range(3):
+            self.assertEqual(await self.get(cid), 204)
+        await asyncio.sleep(0.3)
+        self.assertEqual(await self.get(cid), 410)
+
+
+if __name__ == '__main__':
+    unittest.main()